@@ -17,6 +17,8 @@ dependencies {
     testImplementation(kotlin("test"))
 
     api("com.gitlab.AuroraOSS:gplayapi:0e224071f3")
+    // AuthSession.kt, gplayapi only uses it internally
+    implementation("com.google.code.gson:gson:2.8.7")
 
 }
 
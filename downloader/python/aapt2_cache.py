@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+####################
+# aapt2 wrapper given to apktool (apktool b --use-aapt2 -a aapt2_cache.py) that caches compiled resources.
+# -> "compile --dir res -o resources.zip" compiles every file on its own, the .flat output is kept in
+#    $AAPT2_CACHE keyed by the hash of the file, its path and the compile flags
+# -> only the files missing from the cache are compiled, in parallel batches
+# -> every other command (link, version...) runs the real aapt2
+####################
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import metrics
+
+AAPT2_CACHE = os.environ.get("AAPT2_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "apk-merge", "aapt2"))
+ANDROID_HOME = os.environ.get("ANDROID_HOME", "/opt/android-sdk")
+# files per aapt2 process, keeps the command line short
+BATCH_SIZE = 500
+
+
+####################
+# The aapt2 that really compiles: $AAPT2, the newest one of the SDK build-tools or the one on the PATH
+####################
+def realAapt2():
+    if os.environ.get("AAPT2"):
+        return os.environ["AAPT2"]
+    candidates = sorted(glob(os.path.join(ANDROID_HOME, "build-tools", "*", "aapt2")))
+    if candidates:
+        return candidates[-1]
+    return shutil.which("aapt2")
+
+
+####################
+# apktool arguments to build with the cache, none if there is no aapt2 to wrap
+####################
+def apktoolArgs():
+    if realAapt2() is None:
+        return []
+    return ["--use-aapt2", "-a", os.path.abspath(__file__)]
+
+
+####################
+# Name aapt2 gives to the compiled file: values-en/strings.xml -> values-en_strings.arsc.flat,
+# drawable-hdpi/icon.9.png -> drawable-hdpi_icon.9.png.flat
+####################
+def flatName(relpath):
+    resDir, filename = relpath.split("/")
+    if resDir.split("-")[0] == "values" and filename.endswith(".xml"):
+        return resDir + "_" + filename.split(".")[0] + ".arsc.flat"
+    return resDir + "_" + filename + ".flat"
+
+
+def cacheKey(aapt2, flags, resDir, relpath):
+    stat = os.stat(aapt2)
+    h = hashlib.sha256()
+    h.update(f"{os.path.realpath(aapt2)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    h.update(("\0".join(flags) + "\n" + relpath + "\n").encode())
+    with open(os.path.join(resDir, relpath), "rb") as fh:
+        h.update(fh.read())
+    return h.hexdigest()
+
+
+def compileBatch(aapt2, flags, resDir, relpaths):
+    with tempfile.TemporaryDirectory() as outdir:
+        subprocess.run(
+            [aapt2, "compile"] + flags + ["-o", outdir] + [os.path.join(resDir, p) for p in relpaths],
+            check=True,
+        )
+        return {p: open(os.path.join(outdir, flatName(p)), "rb").read() for p in relpaths}
+
+
+def storeFlat(key, data):
+    path = os.path.join(AAPT2_CACHE, key[:2], key + ".flat")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+
+####################
+# compile --dir <res> -o <zip> [flags], the way apktool calls it
+####################
+def cachedCompile(aapt2, args):
+    args = list(args)
+    resDir = args.pop(args.index("--dir") + 1)
+    args.remove("--dir")
+    output = args.pop(args.index("-o") + 1)
+    args.remove("-o")
+    flags = args
+
+    # aapt2 skips hidden files and directories
+    relpaths = sorted(
+        d + "/" + f
+        for d in os.listdir(resDir)
+        if not d.startswith(".") and os.path.isdir(os.path.join(resDir, d))
+        for f in os.listdir(os.path.join(resDir, d))
+        if not f.startswith(".") and os.path.isfile(os.path.join(resDir, d, f))
+    )
+    keys = {p: cacheKey(aapt2, flags, resDir, p) for p in relpaths}
+    missing = [p for p in relpaths if not os.path.exists(os.path.join(AAPT2_CACHE, keys[p][:2], keys[p] + ".flat"))]
+    print(f"[aapt2 cache] {len(relpaths) - len(missing)} cached, compiling {len(missing)}", file=sys.stderr)
+    metrics.cache_lookups("aapt2", len(relpaths) - len(missing), len(missing))
+
+    batches = [missing[i : i + BATCH_SIZE] for i in range(0, len(missing), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        for flats in pool.map(lambda batch: compileBatch(aapt2, flags, resDir, batch), batches):
+            for p, data in flats.items():
+                storeFlat(keys[p], data)
+
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as zf:
+        for p in relpaths:
+            zf.write(os.path.join(AAPT2_CACHE, keys[p][:2], keys[p] + ".flat"), flatName(p))
+
+
+def main(argv):
+    aapt2 = realAapt2()
+    if aapt2 is None:
+        print("aapt2 not found, set AAPT2 or ANDROID_HOME", file=sys.stderr)
+        return 1
+    if argv[:1] == ["compile"] and "--dir" in argv and "-o" in argv:
+        try:
+            cachedCompile(aapt2, argv[1:])
+            return 0
+        except (OSError, KeyError, subprocess.CalledProcessError) as e:
+            # unexpected input, let aapt2 compile everything as usual
+            print(f"[aapt2 cache] falling back to a full compile: {e}", file=sys.stderr)
+    return subprocess.run([aapt2] + argv).returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
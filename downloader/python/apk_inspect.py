@@ -0,0 +1,241 @@
+####################
+# Inspect an APK without decoding it: the zip central directory and the binary
+# AndroidManifest.xml are read from a memory map of the file.
+# -> base or split (the base has no "split" attribute in its manifest)
+# -> split type: abi, density, language or feature
+# -> ProGuard/AndResGuard markers
+# -> how the split has to be decoded
+# -> whether the split (or a lib/ folder of it) is wanted (see SplitFilter)
+####################
+import mmap
+import struct
+import zipfile
+from dataclasses import dataclass, field
+
+ABIS = {"armeabi", "armeabi_v7a", "arm64_v8a", "x86", "x86_64", "mips", "mips64"}
+DENSITIES = {"ldpi", "mdpi", "tvdpi", "hdpi", "xhdpi", "xxhdpi", "xxxhdpi", "nodpi", "anydpi"}
+
+# Decode modes
+DECODE_FULL = "full"  # apktool d
+DECODE_EXTRACT = "extract"  # only lib/ and assets/, unzip them, no apktool needed
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+UTF8_FLAG = 0x100
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+TYPE_INT_BOOLEAN = 0x12
+
+
+@dataclass
+class ApkInfo:
+    path: str
+    package: str = None
+    split: str = None
+    versionCode: int = None
+    splitType: str = None
+    config: str = None
+    hasDex: bool = False
+    hasResources: bool = False
+    proguard: bool = False
+    entries: list = field(default_factory=list, repr=False)
+
+    @property
+    def isBase(self):
+        return self.split is None
+
+    @property
+    def decodeMode(self):
+        if self.isBase or self.hasDex or self.hasResources:
+            return DECODE_FULL
+        payload = [
+            e
+            for e in self.entries
+            if not e.endswith("/")
+            and e != "AndroidManifest.xml"
+            and not e.startswith("META-INF/")
+        ]
+        if all(e.startswith("lib/") or e.startswith("assets/") for e in payload):
+            return DECODE_EXTRACT
+        return DECODE_FULL
+
+
+def normalizeAbi(abi):
+    # split names use arm64_v8a, lib/ folders arm64-v8a
+    return abi.replace("-", "_")
+
+
+@dataclass
+class SplitFilter:
+    """
+    Configurations to merge, None keeps every one. Configuration splits that
+    do not match are dropped before decoding, and so are the lib/<abi>
+    folders of the other APKs. Resources inside the base are always kept,
+    they can be referenced from anywhere.
+    """
+
+    abis: set = None
+    densities: set = None
+    locales: set = None
+
+    def keepsAbi(self, abi):
+        return self.abis is None or normalizeAbi(abi) in {normalizeAbi(a) for a in self.abis}
+
+    def keepsLocale(self, locale):
+        # "pt" keeps config.pt and config.pt_BR
+        return self.locales is None or any(
+            locale == l or locale.startswith(l + "_") or locale.startswith(l + "-")
+            for l in self.locales
+        )
+
+    def keepsSplit(self, info):
+        if info.splitType == "abi":
+            return self.keepsAbi(info.config)
+        if info.splitType == "density":
+            return self.densities is None or info.config in self.densities
+        if info.splitType == "language":
+            return self.keepsLocale(info.config)
+        return True
+
+    def keepsEntry(self, entry):
+        parts = entry.split("/")
+        if parts[0] == "lib" and len(parts) > 2:
+            return self.keepsAbi(parts[1])
+        return True
+
+
+def _readString(data, poolOffset, index):
+    _, headerSize, _, count, _, flags, stringsStart, _ = struct.unpack_from(
+        "<HHIIIIII", data, poolOffset
+    )
+    if index < 0 or index >= count:
+        return None
+    offset = struct.unpack_from("<I", data, poolOffset + headerSize + index * 4)[0]
+    pos = poolOffset + stringsStart + offset
+    if flags & UTF8_FLAG:
+        # utf-16 length then utf-8 length, both 1 or 2 bytes
+        pos += 2 if data[pos] & 0x80 else 1
+        length = data[pos]
+        if length & 0x80:
+            length = ((length & 0x7F) << 8) | data[pos + 1]
+            pos += 1
+        pos += 1
+        return bytes(data[pos : pos + length]).decode("utf-8", errors="replace")
+    length = struct.unpack_from("<H", data, pos)[0]
+    if length & 0x8000:
+        length = ((length & 0x7FFF) << 16) | struct.unpack_from("<H", data, pos + 2)[0]
+        pos += 2
+    pos += 2
+    return bytes(data[pos : pos + length * 2]).decode("utf-16-le", errors="replace")
+
+
+def parseManifestAttributes(data):
+    """Attributes of the root <manifest> element of a binary AndroidManifest.xml."""
+    chunkType, headerSize, _ = struct.unpack_from("<HHI", data, 0)
+    if chunkType != RES_XML_TYPE:
+        raise ValueError("not a binary xml")
+
+    pool = None
+    pos = headerSize
+    while pos + 8 <= len(data):
+        chunkType, headerSize, size = struct.unpack_from("<HHI", data, pos)
+        if chunkType == RES_STRING_POOL_TYPE:
+            pool = pos
+        elif chunkType == RES_XML_START_ELEMENT_TYPE:
+            attrStart, attrSize, attrCount = struct.unpack_from("<HHH", data, pos + 16 + 8)
+            attrs = {}
+            for i in range(attrCount):
+                a = pos + 16 + attrStart + i * attrSize
+                _, nameIdx, rawIdx, _, _, dataType, value = struct.unpack_from(
+                    "<IIIHBBI", data, a
+                )
+                name = _readString(data, pool, nameIdx)
+                if dataType == TYPE_STRING:
+                    attrs[name] = _readString(data, pool, rawIdx)
+                elif dataType == TYPE_INT_BOOLEAN:
+                    attrs[name] = value != 0
+                elif dataType in (TYPE_INT_DEC, TYPE_INT_HEX):
+                    attrs[name] = value
+                else:
+                    attrs[name] = _readString(data, pool, rawIdx)
+            return attrs
+        if size == 0:
+            break
+        pos += size
+    return {}
+
+
+def classifySplit(split):
+    if split is None:
+        return None, None
+    if "config." not in split:
+        return "feature", None
+    config = split.rsplit("config.", 1)[1]
+    if config in ABIS:
+        return "abi", config
+    if config in DENSITIES:
+        return "density", config
+    return "language", config
+
+
+def detectProGuardInZip(zf, entries):
+    if any(e.startswith("META-INF/proguard/") for e in entries):
+        return True
+    # AndResGuard moves res/ to r/
+    if any(e.startswith("r/") for e in entries):
+        return True
+    if "META-INF/MANIFEST.MF" in entries:
+        if "proguard" in zf.read("META-INF/MANIFEST.MF").decode("utf-8", "replace").lower():
+            return True
+    return False
+
+
+class MappedFile:
+    """Minimal file object over a mmap, zipfile needs seekable() (mmap has it from python 3.13)."""
+
+    def __init__(self, mm):
+        self.mm = mm
+
+    def read(self, n=-1):
+        return self.mm.read(n)
+
+    def seek(self, offset, whence=0):
+        return self.mm.seek(offset, whence)
+
+    def tell(self):
+        return self.mm.tell()
+
+    def seekable(self):
+        return True
+
+
+def inspectApk(path):
+    with open(path, "rb") as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with zipfile.ZipFile(MappedFile(mm)) as zf:
+                entries = zf.namelist()
+                attrs = parseManifestAttributes(zf.read("AndroidManifest.xml"))
+                info = ApkInfo(
+                    path=path,
+                    package=attrs.get("package"),
+                    split=attrs.get("split"),
+                    versionCode=attrs.get("versionCode"),
+                    hasDex=any(e.startswith("classes") and e.endswith(".dex") for e in entries),
+                    hasResources="resources.arsc" in entries,
+                    proguard=detectProGuardInZip(zf, entries),
+                    entries=entries,
+                )
+    info.splitType, info.config = classifySplit(info.split)
+    return info
+
+
+def extractApk(info, apkdir, splitFilter=None):
+    """Unzip the payload of a split that does not need apktool (see DECODE_EXTRACT)."""
+    with zipfile.ZipFile(info.path) as zf:
+        for e in info.entries:
+            if splitFilter is not None and not splitFilter.keepsEntry(e):
+                continue
+            if e.startswith("lib/") or e.startswith("assets/"):
+                zf.extract(e, apkdir)
@@ -0,0 +1,84 @@
+import json
+import os
+import re
+import shutil
+import xml.etree.ElementTree
+import zipfile
+from pathlib import Path
+
+# shared by merge_apk.py and patcher/patcher.py, the files written with the apks they build
+
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def normalize_apk(apk):
+    """
+    Rewrites the apk with its entries sorted by name and a fixed timestamp, so
+    identical inputs build byte-identical apks. Entries keep their compression
+    method (e.g. resources.arsc stays stored).
+    """
+    tmp = f"{apk}.tmp"
+    with zipfile.ZipFile(apk) as src, zipfile.ZipFile(tmp, "w") as dst:
+        for info in sorted(src.infolist(), key=lambda i: i.filename):
+            entry = zipfile.ZipInfo(info.filename, ZIP_EPOCH)
+            entry.compress_type = info.compress_type
+            entry.create_system = 0
+            entry.external_attr = 0
+            dst.writestr(entry, src.read(info))
+    os.replace(tmp, apk)
+
+
+DENSITIES = ["xxxhdpi", "xxhdpi", "xhdpi", "hdpi", "mdpi", "ldpi"]
+
+
+def read_apktool_yml(workfolder, key):
+    data = (Path(workfolder) / "apktool.yml").read_text()
+    m = re.search(r"^\s*" + key + r":\s*'?([^'\n]+)'?\s*$", data, re.MULTILINE)
+    return m.group(1) if m else None
+
+
+def find_icon(workfolder, icon):
+    if icon is None or not icon.startswith("@") or "/" not in icon:
+        return None
+    res_type, name = icon[1:].split("/", 1)
+    for density in DENSITIES:
+        for folder in sorted(Path(workfolder).glob(f"res/{res_type}-*{density}*")):
+            if (folder / f"{name}.png").exists():
+                return folder / f"{name}.png"
+    return None
+
+
+def write_metadata(workfolder, apk):
+    """
+    Writes <apk>.json (package, version, sdk, permissions, native code) and
+    <apk>.png (launcher icon) next to the apk, used to update the repo index
+    without scanning the apk again.
+    """
+    workfolder = Path(workfolder)
+    manifest = xml.etree.ElementTree.parse(workfolder / "AndroidManifest.xml").getroot()
+    ns = "{http://schemas.android.com/apk/res/android}"
+    application = manifest.find("application")
+    lib = workfolder / "lib"
+
+    metadata = {
+        "packageName": manifest.attrib["package"],
+        "versionCode": int(read_apktool_yml(workfolder, "versionCode")),
+        "versionName": read_apktool_yml(workfolder, "versionName"),
+        "minSdkVersion": read_apktool_yml(workfolder, "minSdkVersion"),
+        "targetSdkVersion": read_apktool_yml(workfolder, "targetSdkVersion"),
+        "permissions": sorted(
+            el.attrib[ns + "name"]
+            for el in manifest.findall("uses-permission")
+            if ns + "name" in el.attrib
+        ),
+        "nativecode": sorted(d.name for d in lib.iterdir()) if lib.is_dir() else [],
+        "icon": None,
+    }
+
+    icon = find_icon(workfolder, application.attrib.get(ns + "icon") if application is not None else None)
+    if icon is not None:
+        shutil.copy(icon, Path(apk).with_suffix(".png"))
+        metadata["icon"] = Path(apk).with_suffix(".png").name
+
+    with Path(apk).with_suffix(".json").open(mode="w") as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
@@ -0,0 +1,66 @@
+import click
+import subprocess
+
+import entrypoint
+
+
+def available_profiles():
+    CMD = entrypoint.java(entrypoint.DOWNLOADER_JAR) + ["--list-profiles"]
+    return subprocess.run(CMD, check=True, capture_output=True, text=True).stdout.split()
+
+
+def list_splits(mail, aastoken, packagename, profile):
+    """(name, size) of every file the store gives the profile, nothing is downloaded."""
+    CMD = (
+        entrypoint.java(entrypoint.DOWNLOADER_JAR)
+        + entrypoint.profile_args(profile)
+        + ["--list-splits", mail, aastoken, packagename]
+    )
+    stdout = subprocess.run(CMD, check=True, capture_output=True, text=True).stdout
+    splits = []
+    for line in stdout.splitlines():
+        if line.startswith("split\t"):
+            _, name, size = line.split("\t")
+            splits.append((name, int(size)))
+    return splits
+
+
+@click.command()
+@click.argument("mail")
+@click.argument("aastoken")
+@click.argument("packagenames", nargs=-1, required=True)
+@click.option("--profile", "profiles", multiple=True, help="profile to compare, can be repeated, all the bundled ones by default")
+@click.option("--verbose", is_flag=True, help="also list the files of every split set")
+def compare(mail, aastoken, packagenames, profiles, verbose):
+    """Split set every device profile gets for the packages, the smallest download first."""
+    profiles = profiles or available_profiles()
+    totals = {}
+    print(f"{'profile':<20}{'package':<35}{'splits':>8}{'size (MB)':>12}")
+    for profile in profiles:
+        count, size, missing = 0, 0, 0
+        for packagename in packagenames:
+            try:
+                splits = list_splits(mail, aastoken, packagename, profile)
+            except subprocess.CalledProcessError:
+                # not compatible with the profile (or not available with it)
+                print(f"{profile:<20}{packagename:<35}{'-':>8}{'-':>12}")
+                missing += 1
+                continue
+            package_size = sum(s for _, s in splits)
+            print(f"{profile:<20}{packagename:<35}{len(splits):>8}{package_size / 2**20:>12.1f}")
+            if verbose:
+                for name, split_size in splits:
+                    print(f"{'':<24}{name:<39}{split_size / 2**20:>12.1f}")
+            count += len(splits)
+            size += package_size
+        totals[profile] = (missing, size, count)
+
+    print()
+    print(f"{'profile':<20}{'splits':>8}{'size (MB)':>12}{'missing':>9}")
+    # a profile that cannot get a package is never the best one
+    for profile, (missing, size, count) in sorted(totals.items(), key=lambda item: item[1]):
+        print(f"{profile:<20}{count:>8}{size / 2**20:>12.1f}{missing:>9}")
+
+
+if __name__ == "__main__":
+    compare()
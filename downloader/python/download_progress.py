@@ -0,0 +1,91 @@
+####################
+# Follow a download in progress, so the merge can decode the splits that are already there.
+# The downloader (Main.kt) writes into the output folder:
+# -> download.manifest: the names of every file it is going to download, before the first one
+# -> <name>.part while a file downloads, renamed to <name> once it is complete
+# -> download.ready once every file is there
+####################
+import os
+import time
+
+MANIFEST = "download.manifest"
+READY = "download.ready"
+
+
+class DownloadError(Exception):
+    pass
+
+
+####################
+# Remove the markers of a previous download, before starting a new one in the same folder
+####################
+def clearMarkers(folder):
+    for marker in (MANIFEST, READY):
+        if os.path.exists(os.path.join(folder, marker)):
+            os.remove(os.path.join(folder, marker))
+
+
+class DownloadWatcher:
+    def __init__(self, folder, process=None, pollInterval=0.2):
+        self.folder = str(folder)
+        # downloader subprocess.Popen, a failed download ends the wait
+        self.process = process
+        self.pollInterval = pollInterval
+        self.started = time.time()
+        # seconds until every file was there
+        self.seconds = None
+
+    ####################
+    # Exit code of the downloader, None while it runs. The process is not reaped (no poll()),
+    # its waiter gets its exit status and its memory, see perf_history.wait
+    ####################
+    def exitCode(self):
+        if self.process is None or self.process.returncode is not None:
+            return None if self.process is None else self.process.returncode
+        try:
+            info = os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            # reaped by its waiter in between
+            return self.process.returncode
+        if info is None:
+            return None
+        return info.si_status if info.si_code == os.CLD_EXITED else -info.si_status
+
+    def checkProcess(self):
+        code = self.exitCode()
+        if code not in (None, 0):
+            raise DownloadError(f"the downloader failed with exit code {code}")
+
+    def exited(self):
+        return self.exitCode() == 0
+
+    ####################
+    # Names of the apks that are going to be downloaded, waits for the manifest
+    ####################
+    def expected(self):
+        manifest = os.path.join(self.folder, MANIFEST)
+        while not os.path.exists(manifest):
+            self.checkProcess()
+            if self.exited() and not os.path.exists(manifest):
+                # downloader without markers, everything is there once it exits
+                return sorted(f for f in os.listdir(self.folder) if f.endswith(".apk"))
+            time.sleep(self.pollInterval)
+        with open(manifest) as fh:
+            return [name for name in fh.read().splitlines() if name.endswith(".apk")]
+
+    ####################
+    # Paths of the apks in the order they are complete, ends when all of them are there
+    ####################
+    def arrivals(self):
+        pending = self.expected()
+        while pending:
+            arrived = [name for name in pending if os.path.exists(os.path.join(self.folder, name))]
+            for name in arrived:
+                pending.remove(name)
+                yield os.path.join(self.folder, name)
+            if not arrived:
+                self.checkProcess()
+                if self.exited() and not any(os.path.exists(os.path.join(self.folder, name)) for name in pending):
+                    raise DownloadError(f"the downloader exited without downloading {', '.join(pending)}")
+                time.sleep(self.pollInterval)
+        self.seconds = time.time() - self.started
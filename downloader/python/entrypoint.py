@@ -1,26 +1,134 @@
 import click
+import os
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+from pathlib import Path
 
-def run_downloader(mail, aastoken, packagename):
+import download_progress
+import metrics
+import perf_history
+from jvm import shared_archive
+
+DOWNLOADER_JAR = os.environ.get(
+    "DOWNLOADER_JAR", "build/libs/apkdownloader-1.0-SNAPSHOT-all.jar"
+)
+
+
+def java(jar, heap_mb=None):
+    # absolute path, the archive is only used with the classpath it was made for
+    jar = str(Path(jar).resolve())
+    heap = [f"-Xmx{heap_mb}m"] if heap_mb else []
+    return ["java"] + heap + shared_archive(jar) + ["-jar", jar]
+
+
+def profile_args(device_profile):
+    # device the store sees, see device_profiles.py to compare them
+    return ["--device-profile", device_profile] if device_profile else []
+
+
+def start_downloader(mail, aastoken, packagename, output_dir="output", heap_mb=None, device_profile=None):
     print("[*] Downloading apks from playstore")
-    CMD = ["java", "-jar", "build/libs/apkdownloader-1.0-SNAPSHOT-all.jar", mail, aastoken, packagename]
-    subprocess.run(CMD, check=True)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    # the markers of the last download would make its apks look ready
+    download_progress.clearMarkers(output_dir)
+    CMD = java(DOWNLOADER_JAR, heap_mb) + profile_args(device_profile) + [mail, aastoken, packagename, str(output_dir)]
+    return subprocess.Popen(CMD)
+
 
-def run_merger(packagename, dest):
+def record_download(perf, output_dir):
+    apks = list(Path(output_dir).glob("*.apk"))
+    size = sum(apk.stat().st_size for apk in apks)
+    perf.record(splits=len(apks), output_size=size)
+    metrics.inc("downloaded_bytes_total", size)
+
+
+def run_downloader(mail, aastoken, packagename, output_dir="output", heap_mb=None, device_profile=None):
+    with metrics.stage("download"), perf_history.run("download", packagename) as perf:
+        with perf_history.phase("download"), metrics.jvm():
+            process = start_downloader(mail, aastoken, packagename, output_dir, heap_mb, device_profile)
+            if perf_history.wait(process) != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        record_download(perf, output_dir)
+
+def wait_downloader(process, perf):
+    """The one waiter of a downloader started by download: its exit code, its memory and the gauge."""
+    try:
+        perf_history.wait(process, perf)
+    finally:
+        metrics.jvm_count(-1)
+
+
+def run_merger(
+    packagename,
+    dest,
+    input_folder="output",
+    write_metadata=False,
+    no_src=True,
+    patcher_dir=None,
+    deterministic=True,
+    heap_mb=None,
+    abis=None,
+    densities=None,
+    locales=None,
+    download=None,
+):
     print("[*] merging split apks")
-    CMD = ["python3", "merge_apk.py", "--debug-output", packagename, "../output/", dest]
-    subprocess.run(CMD, cwd="python/", check=True)
+    # in this process, merge_apk.py is only imported by the callers that merge
+    import merge_apk
+
+    if patcher_dir is not None and str(patcher_dir) not in sys.path:
+        # patch the merged tree in the same pass, see merge_apk.py --patch
+        sys.path.insert(0, str(patcher_dir))
+    options = merge_apk.MergeOptions(
+        pkgname=packagename,
+        input_folder=str(input_folder),
+        save_apk=str(dest),
+        debug_output=True,
+        patch=patcher_dir is not None,
+        # the merge never touches the code, the dex files are carried as they are
+        no_src=no_src,
+        deterministic=deterministic,
+        write_metadata=write_metadata,
+        abis=set(abis) if abis else None,
+        densities=set(densities) if densities else None,
+        locales=set(locales) if locales else None,
+        heap_mb=heap_mb,
+        download=download,
+    )
+    return merge_apk.merge_splits(options)
 
 @click.command()
 @click.argument('mail')
 @click.argument('aastoken')
 @click.argument('packagename')
 @click.argument('dest')
-def download(mail, aastoken, packagename, dest):
-    run_downloader(mail, aastoken, packagename)
-
-    run_merger(packagename, dest)
+@click.option('--device-profile', default=None, help='bundled device profile the store sees, see device_profiles.py')
+def download(mail, aastoken, packagename, dest, device_profile):
+    # the merge decodes every apk as soon as it is downloaded
+    perf = perf_history.PerfRun("download", packagename)
+    process = start_downloader(mail, aastoken, packagename, device_profile=device_profile)
+    metrics.jvm_count(1)
+    # the downloader exits while the merge goes on, it is reaped as soon as it does
+    waiter = threading.Thread(target=wait_downloader, args=(process, perf), daemon=True)
+    waiter.start()
+    watcher = download_progress.DownloadWatcher("output", process)
+    try:
+        run_merger(packagename, dest, download=watcher)
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        waiter.join()
+        seconds = watcher.seconds or time.time() - watcher.started
+        perf.phases.append(("download", seconds))
+        record_download(perf, "output")
+        perf.save(process.returncode == 0)
+        metrics.record_stage("download", seconds, process.returncode == 0)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
 
 if __name__ == '__main__':
-    download()
\ No newline at end of file
+    download()
@@ -0,0 +1,12 @@
+from pathlib import Path
+
+# shared by entrypoint.py, merge_apk.py and patcher/patcher.py
+
+
+def shared_archive(jar):
+    # class-data-sharing archive of the jar (made by pipeline/cds.py when the
+    # pipeline image is built), the jvm ignores it if it does not match the jar
+    archive = Path(jar).with_suffix(".jsa")
+    if not archive.exists():
+        return []
+    return [f"-XX:SharedArchiveFile={archive}", "-Xshare:auto"]
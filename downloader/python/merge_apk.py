@@ -1,94 +1,269 @@
 #!/usr/bin/python3
 import argparse
+import contextvars
+import functools
+import inspect
 import os
-import pkg_resources
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import xml.etree.ElementTree
 import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
 from glob import glob
-from sys import exit
 from pathlib import Path
 
+# the other helpers (xml_backend, perf_history, metrics...) are imported by the
+# functions that use them, importing this module costs next to nothing
+from jvm import shared_archive
+
+APK_TOOL_JAR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "apktool-cli-all.jar")
+APK_TOOL = ["java"] + shared_archive(APK_TOOL_JAR) + ["-jar", APK_TOOL_JAR]
+
+# Options of the merge running in the current thread, read by dbgPrint/getStdout/runApkTool
+currentOptions = contextvars.ContextVar("currentOptions")
+
+
 ####################
-# Main()
+# Library API
 ####################
+class MergeError(Exception):
+    pass
+
 
-APK_TOOL = [
-    "java",
-    "-jar",
-    "apktool-cli-all.jar",
-]
+@dataclass
+class MergeOptions:
+    pkgname: str
+    input_folder: str
+    save_apk: str
+    disable_styles_hack: bool = False
+    debug_output: bool = False
+    # apply the patch of patcher.py (must be importable) before rebuilding
+    patch: bool = False
+    deterministic: bool = False
+    no_src: bool = False
+    write_metadata: bool = False
+    abis: set = None
+    densities: set = None
+    locales: set = None
+    # -Xmx of the apktool JVMs
+    heap_mb: int = None
+    # check the resource references before building, see resource_check.py
+    validate: bool = True
+    # unresolved references fail the merge too, not only broken public ids
+    strict_validate: bool = False
+    # DownloadWatcher of a download still going on into input_folder, the apks are
+    # decoded as they arrive and only the reconciliation waits for all of them
+    download: "download_progress.DownloadWatcher" = None
+    # skip the phases the last merge of input_folder finished, see merge_checkpoint.py
+    resume: bool = False
 
 
-def main():
+@dataclass
+class MergeResult:
+    apk: str
+    package: str = None
+    versionCode: int = None
+    # False if the input was a single APK, copied as it is
+    merged: bool = True
+    splits: list = field(default_factory=list)
+    skipped: list = field(default_factory=list)
+
+
+def merge_splits(options):
+    """
+    Merge the split APKs of options.input_folder into options.save_apk, in
+    this process. Raises MergeError if something fails, the original error
+    (XML parse error, failed assumption of the public id reconciliation,
+    patch error...) is its __cause__. Every call only uses its own options,
+    so batch drivers can run many merges, also in threads.
+    """
+    import metrics
+    import perf_history
+
+    token = currentOptions.set(options)
+    try:
+        with metrics.stage("merge"), perf_history.run("merge", options.pkgname):
+            return _mergeSplits(options)
+    except MergeError:
+        raise
+    except Exception as e:
+        raise MergeError(f"{type(e).__name__}: {e}") from e
+    finally:
+        currentOptions.reset(token)
+
+
+def _mergeSplits(options):
+    import download_progress
+    import perf_history
+    from apk_inspect import SplitFilter, inspectApk
+    from apk_output import write_metadata
+    from merge_checkpoint import Checkpoints
+
     # Check that dependencies are available
     checkDependencies()
 
-    # Grab argz
-    args = getArgs()
-    pkgname = args.pkgname
-
-    apks = glob(f"{args.input_folder}/*.apk")
+    apkInfos = {}
+    decoded = {}
+    checkpoints = Checkpoints(options.input_folder, options.resume)
+    if options.download is not None:
+        try:
+            with perf_history.phase("download+decode"):
+                apkInfos, decoded = decodeWhileDownloading(options, checkpoints)
+        except download_progress.DownloadError as e:
+            raise MergeError(str(e))
+        apks = list(apkInfos)
+    else:
+        apks = glob(f"{options.input_folder}/*.apk")
 
     if len(apks) == 0:
-        raise Exception(f"No apk found in {args.input_folder}")
+        raise MergeError(f"No apk found in {options.input_folder}")
     elif len(apks) == 1:
-        shutil.copy(apks[0], args.save_apk)
-        exit(0)
-    else:
-        base = [apk for apk in apks if pkgname in apk]
-        if len(base) != 1:
-            raise Exception(f"found {len(base)} base apks... it should be just one")
-        else:
-            baseapk = base[0]
-            apks.remove(baseapk)
+        shutil.copy(apks[0], options.save_apk)
+        perf_history.record(splits=1, output_size=perf_history.file_size(options.save_apk))
+        return MergeResult(options.save_apk, merged=False)
+
+    # The base is the only APK without a "split" attribute in its manifest
+    with perf_history.phase("inspect"):
+        for apk in apks:
+            if apk not in apkInfos:
+                apkInfos[apk] = inspectApk(apk)
+    for apk, info in apkInfos.items():
+        dbgPrint(f"[~] {apk}: split={info.split} type={info.splitType} decode={info.decodeMode}")
+    base = [apk for apk in apks if apkInfos[apk].isBase]
+    if len(base) != 1:
+        raise MergeError(f"found {len(base)} base apks... it should be just one")
+    baseapk = base[0]
+    apks.remove(baseapk)
+
+    # Drop the configuration splits we do not deploy before decoding anything
+    splitFilter = SplitFilter(options.abis, options.densities, options.locales)
+    skipped = []
+    for apk in list(apks):
+        if not splitFilter.keepsSplit(apkInfos[apk]):
+            print("[-] Skipping " + apkInfos[apk].splitType + " split: " + apk)
+            apks.remove(apk)
+            skipped.append(apk)
+
+    perf_history.record(
+        package=apkInfos[baseapk].package,
+        version_code=apkInfos[baseapk].versionCode,
+        splits=len(apks) + 1,
+    )
+
+    # Patch of patcher.py for this package, applied to the decoded base before the final build
+    patch = findPatch(options, apkInfos[baseapk].package)
+    if options.patch and patch is None:
+        print("[~] No patch for " + apkInfos[baseapk].package + ", only merging.")
 
     # Create a temp directory to work from
     with tempfile.TemporaryDirectory() as tmppath:
         # Get the APK to patch. Combine app bundles/split APKs into a single APK.
-        apkfile = combineSplitAPKs(
-            pkgname, baseapk, apks, tmppath, args.disable_styles_hack, args.save_apk
+        combineSplitAPKs(
+            options.pkgname,
+            baseapk,
+            apks,
+            tmppath,
+            options.disable_styles_hack,
+            options.save_apk,
+            apkInfos,
+            options.no_src,
+            patch,
+            options.deterministic,
+            splitFilter,
+            options.validate,
+            decoded,
+            checkpoints,
+            options.strict_validate,
         )
 
-        # Patch the target APK with objection
-        # print("Patching " + apkfile.split(os.sep)[-1] + " with objection.")
-        # ret = None
-        # if getObjectionVersion() >= pkg_resources.parse_version("1.9.3"):
-        # 	ret = subprocess.run(["objection", "patchapk", "--skip-resources", "--ignore-nativelibs", "-s", apkfile], stdout=getStdout())
-        # else:
-        # 	ret = subprocess.run(["objection", "patchapk", "--skip-resources", "-s", apkfile], stdout=getStdout())
-        # if ret.returncode != 0:
-        # 	print("Error: Failed to run 'objection patchapk --skip-resources -s " + apkfile + "'.\nRun with --debug-output for more information.")
-        # 	sys.exit(1)
-        # os.remove(apkfile)
-        # shutil.move(apkfile[:-4] + ".objection.apk", apkfile)
-        # print("")
-
-        # #Enable support for user-installed CA certs (e.g. Burp Suite CA installed on device by user)
-        # if args.no_enable_user_certs == False:
-        # 	enableUserCerts(apkfile)
-
-        # #Uninstall the original package from the device
-        # print("Uninstalling the original package from the device.")
-        # ret = subprocess.run(["adb", "uninstall", pkgname], stdout=getStdout())
-        # if ret.returncode != 0:
-        # 	print("Error: Failed to run 'adb uninstall " + pkgname + "'.\nRun with --debug-output for more information.")
-        # 	sys.exit(1)
-        # print("")
-
-        # #Install the patched APK
-        # print("Installing the patched APK to the device.")
-        # ret = subprocess.run(["adb", "install", apkfile], stdout=getStdout())
-        # if ret.returncode != 0:
-        # 	print("Error: Failed to run 'adb install " + apkfile + "'.\nRun with --debug-output for more information.")
-        # 	sys.exit(1)
-        # print("")
-
-        # #Done
-        # print("Done, cleaning up temporary files.")
+        if options.write_metadata:
+            with perf_history.phase("metadata"):
+                write_metadata(baseapk[:-4], options.save_apk)
+
+    perf_history.record(output_size=perf_history.file_size(options.save_apk))
+
+    return MergeResult(
+        options.save_apk,
+        package=apkInfos[baseapk].package,
+        versionCode=apkInfos[baseapk].versionCode,
+        splits=apks,
+        skipped=skipped,
+    )
+
+
+####################
+# Patch of patcher.py for a package, None if there is none or patching is off
+####################
+def findPatch(options, package):
+    if not options.patch:
+        return None
+    import patcher
+
+    return patcher.PATCHES.get(package)
+
+
+####################
+# Inspect and decode the apks while they are downloaded. Splits that arrive before
+# the base wait for it, whether the sources are decoded depends on its patch.
+####################
+def decodeWhileDownloading(options, checkpoints):
+    from apk_inspect import SplitFilter, inspectApk
+
+    apkInfos = {}
+    decoded = {}
+    splitFilter = SplitFilter(options.abis, options.densities, options.locales)
+    # a single apk is copied as it is, nothing to decode
+    merging = len(options.download.expected()) > 1
+    noSrc = None
+    waiting = []
+    for apk in options.download.arrivals():
+        print("[+] Downloaded: " + apk)
+        apkInfos[apk] = inspectApk(apk)
+        if not merging or not splitFilter.keepsSplit(apkInfos[apk]):
+            continue
+        if apkInfos[apk].isBase:
+            noSrc = options.no_src and findPatch(options, apkInfos[apk].package) is None
+        waiting.append(apk)
+        if noSrc is None:
+            continue
+        for apkpath in waiting:
+            decoded[apkpath] = decodeApk(apkpath, apkInfos[apkpath], noSrc, splitFilter, checkpoints)
+        waiting = []
+    return apkInfos, decoded
+
+
+####################
+# Main()
+####################
+def main():
+    # Grab argz
+    args = getArgs()
+    options = MergeOptions(
+        pkgname=args.pkgname,
+        input_folder=args.input_folder,
+        save_apk=args.save_apk,
+        disable_styles_hack=args.disable_styles_hack,
+        debug_output=args.debug_output,
+        patch=args.patch,
+        deterministic=args.deterministic,
+        no_src=args.no_src,
+        write_metadata=args.write_metadata,
+        abis=args.abis,
+        densities=args.densities,
+        locales=args.locales,
+        validate=not args.no_validate,
+        strict_validate=args.strict_validate,
+        resume=args.resume,
+    )
+    try:
+        merge_splits(options)
+    except MergeError as e:
+        print("Error: " + str(e))
+        sys.exit(1)
 
 
 ####################
@@ -104,11 +279,10 @@ def checkDependencies():
         if shutil.which(dep) is None:
             missing.append(dep)
     if len(missing) > 0:
-        print(
-            "Error, missing dependencies, ensure the following commands are available on the PATH: "
+        raise MergeError(
+            "missing dependencies, ensure the following commands are available on the PATH: "
             + (", ".join(missing))
         )
-        sys.exit(1)
 
 
 ####################
@@ -129,6 +303,56 @@ def getArgs():
         parser.add_argument(
             "--debug-output", help="Enable debug output.", action="store_true"
         )
+        parser.add_argument(
+            "--patch",
+            help="Apply the patch of patcher.py (must be importable, e.g. through PYTHONPATH) for the package before rebuilding, instead of decoding the merged APK again in a separate patch step.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--deterministic",
+            help="Make the merged APK reproducible: sorted public.xml, sorted zip entries with fixed timestamps.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--no-src",
+            help="Only decode resources (apktool d -s), the original classes*.dex files are copied into the merged APK untouched.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--abis",
+            help="Comma separated ABIs to keep (e.g. arm64_v8a), the other ABI splits and lib/ folders are not merged.",
+            type=parseList,
+        )
+        parser.add_argument(
+            "--densities",
+            help="Comma separated densities to keep (e.g. xxhdpi), the other density splits are not merged.",
+            type=parseList,
+        )
+        parser.add_argument(
+            "--locales",
+            help="Comma separated locales to keep (e.g. en,es), the other language splits are not merged.",
+            type=parseList,
+        )
+        parser.add_argument(
+            "--resume",
+            help="Skip the phases (decode of every APK, resources, copy, styles, manifest, patch, build) the last merge of the input folder finished with the same inputs.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--no-validate",
+            help="Do not check the resource references of the merged tree before building it.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--strict-validate",
+            help="Fail on unresolved resource references too, they are only printed by default.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--write-metadata",
+            help="Write package name, version and icon of the merged APK next to it (<save_apk>.json / .png).",
+            action="store_true",
+        )
         parser.add_argument(
             "pkgname",
             help="The name, or partial name, of the package to patch (e.g. com.foo.bar).",
@@ -151,11 +375,18 @@ def getArgs():
     return getArgs.parsed_args
 
 
+####################
+# Comma separated list argument
+####################
+def parseList(value):
+    return {v.strip() for v in value.split(",") if v.strip()}
+
+
 ####################
 # Debug print
 ####################
 def dbgPrint(msg):
-    if getArgs().debug_output == True:
+    if currentOptions.get().debug_output == True:
         print(msg)
 
 
@@ -163,7 +394,7 @@ def dbgPrint(msg):
 # Get the stdout target for subprocess calls. Set to DEVNULL unless debug output is enabled.
 ####################
 def getStdout():
-    if getArgs().debug_output == True:
+    if currentOptions.get().debug_output == True:
         return None
     else:
         return subprocess.DEVNULL
@@ -172,26 +403,161 @@ def getStdout():
 ####################
 # Get apktool version
 ####################
+@functools.lru_cache(maxsize=None)
 def getApktoolVersion():
     proc = subprocess.run(APK_TOOL + ["-version"], stdout=subprocess.PIPE)
-    return pkg_resources.parse_version(
-        proc.stdout.decode("utf-8").strip().split("-")[0].strip()
-    )
+    return parseVersion(proc.stdout.decode("utf-8").strip().split("-")[0].strip())
+
+
+####################
+# "2.5.0" -> (2, 5, 0), comparable as a tuple
+####################
+def parseVersion(version):
+    return tuple(int(part) for part in re.findall(r"\d+", version))
 
 
 ####################
 # Wrapper to run apktool platform-independently, complete with a dirty hack to fix apktool's dirty hack.
 ####################
 def runApkTool(params):
-    _args = [] + APK_TOOL
+    import metrics
+    import perf_history
+
+    heap_mb = currentOptions.get().heap_mb
+    _args = APK_TOOL[:1] + ([f"-Xmx{heap_mb}m"] if heap_mb else []) + APK_TOOL[1:]
     _args.extend(params)
-    return subprocess.run(_args, stdout=getStdout())
+    with metrics.jvm():
+        return perf_history.run_process(_args, stdout=getStdout())
+
+
+####################
+# aapt2 flags of apktool b, compiled resources are cached if there is an aapt2 to wrap (see aapt2_cache.py)
+####################
+def aapt2Args():
+    import aapt2_cache
+
+    return aapt2_cache.apktoolArgs() or ["--use-aapt2"]
+
+
+####################
+# Remove the lib/<abi> folders of a decoded APK that the filter does not keep.
+####################
+def removeFilteredLibs(apkdir, splitFilter):
+    libdir = os.path.join(apkdir, "lib")
+    if not os.path.isdir(libdir):
+        return
+    for abi in os.listdir(libdir):
+        if not splitFilter.keepsAbi(abi):
+            dbgPrint("[-] Removing lib/" + abi + " from " + apkdir)
+            shutil.rmtree(os.path.join(libdir, abi))
+
+
+####################
+# Checkpoint of the decode of an APK: its content and how it is decoded
+####################
+def decodePhase(apkpath):
+    from merge_checkpoint import DECODE
+
+    return DECODE + os.path.basename(apkpath)
+
+
+def decodeKey(apkpath, noSrc, splitFilter):
+    from merge_checkpoint import fileDigest, hashOf
+
+    filters = None
+    if splitFilter is not None:
+        filters = [sorted(f) if f else None for f in (splitFilter.abis, splitFilter.densities, splitFilter.locales)]
+    return hashOf(fileDigest(apkpath), noSrc, filters, getApktoolVersion())
+
+
+####################
+# Decode an APK (or unzip it, see DECODE_EXTRACT) into the folder next to it, unless it already was
+####################
+def decodeApk(apkpath, info, noSrc, splitFilter, checkpoints=None):
+    from merge_checkpoint import Checkpoints
+
+    apkdir = apkpath[:-4]
+    if checkpoints is None:
+        checkpoints = Checkpoints()
+    key = decodeKey(apkpath, noSrc, splitFilter)
+    if checkpoints.skip(decodePhase(apkpath), key, apkdir):
+        return apkdir
+    with checkpoints.phase(decodePhase(apkpath), key):
+        return _decodeApk(apkpath, info, noSrc, splitFilter)
+
+
+def _decodeApk(apkpath, info, noSrc, splitFilter):
+    from apk_inspect import DECODE_EXTRACT, extractApk
+
+    apkdir = apkpath[:-4]
+
+    # Check for ProGuard/AndResGuard - this might b0rk decompile/recompile
+    if info.proguard:
+        print(
+            "\n[~] WARNING: Detected ProGuard/AndResGuard in " + apkpath + ", decompile/recompile may not succeed.\n"
+        )
+
+    # Splits with only native libraries/assets (e.g. ABI splits) are just unzipped
+    if info.decodeMode == DECODE_EXTRACT:
+        print("[+] Unzipping " + info.splitType + " split: " + apkpath + " to " + apkdir)
+        shutil.rmtree(apkdir, ignore_errors=True)
+        extractApk(info, apkdir, splitFilter)
+        return apkdir
+
+    print("[+] Extracting: " + apkpath + " to " + apkdir)
+    ret = runApkTool(
+        [
+            "d",
+            "-f",
+        ]
+        + (["-s"] if noSrc else [])
+        + [
+            "-o",
+            apkdir,
+            apkpath,
+        ]
+    )
+    if ret.returncode != 0:
+        raise MergeError(
+            "Failed to run 'apktool d "
+            + apkpath
+            + " -o "
+            + apkdir
+            + "'.\nRun with --debug-output for more information."
+        )
+
+    if splitFilter is not None:
+        removeFilteredLibs(apkdir, splitFilter)
+
+    return apkdir
 
 
 ####################
 # Combine app bundles/split APKs into a single APK for patching.
 ####################
-def combineSplitAPKs(pkgname, baseapk, configapks, tmppath, disableStylesHack, dest):
+def combineSplitAPKs(
+    pkgname,
+    baseapk,
+    configapks,
+    tmppath,
+    disableStylesHack,
+    dest,
+    apkInfos=None,
+    noSrc=False,
+    patch=None,
+    deterministic=False,
+    splitFilter=None,
+    validate=True,
+    decoded=None,
+    checkpoints=None,
+    strictValidate=False,
+):
+    import perf_history
+    import resource_check
+    from apk_inspect import inspectApk
+    from apk_output import normalize_apk
+    from merge_checkpoint import Checkpoints, hashOf
+
     print("App bundle/split APK detected, rebuilding as a single APK.")
     print("")
 
@@ -199,98 +565,152 @@ def combineSplitAPKs(pkgname, baseapk, configapks, tmppath, disableStylesHack, d
     print("Extracting individual APKs with apktool.")
     baseapkfilename = baseapk
     splitapkpaths = []
-    localapks = configapks + [baseapk]
-    for apkpath in localapks:
-        apkdir = apkpath[:-4]
-        print("[+] Extracting: " + apkpath + " to " + apkdir)
-        ret = runApkTool(
-            [
-                "d",
-                "-f",
-                "-o",
-                apkdir,
-                apkpath,
-            ]
-        )
-        if ret.returncode != 0:
-            print(
-                "Error: Failed to run 'apktool d "
-                + apkpath
-                + " -o "
-                + apkdir
-                + "'.\nRun with --debug-output for more information."
-            )
-            sys.exit(1)
+    # Patches edit smali, so the sources are needed
+    noSrc = noSrc and patch is None
+    if checkpoints is None:
+        checkpoints = Checkpoints()
 
-        # Record the destination paths of all but the base APK
-        if apkpath != baseapk:
-            splitapkpaths.append(apkdir)
-        else:
-            baseapkdir = apkdir
+    localapks = configapks + [baseapk]
+    if apkInfos is None:
+        apkInfos = {apk: inspectApk(apk) for apk in localapks}
+    decodeKeys = {apk: decodeKey(apk, noSrc, splitFilter) for apk in localapks}
+    checkpoints.keepDecodes({decodePhase(apk): (decodeKeys[apk], apk[:-4]) for apk in localapks})
+    with perf_history.phase("decode"):
+        for apkpath in localapks:
+            # Decoded while the download was still going on
+            if decoded and apkpath in decoded and checkpoints.done(decodePhase(apkpath), decodeKeys[apkpath]):
+                apkdir = decoded[apkpath]
+            else:
+                apkdir = decodeApk(apkpath, apkInfos[apkpath], noSrc, splitFilter, checkpoints)
 
-        # Check for ProGuard/AndResGuard - this might b0rk decompile/recompile
-        if detectProGuard(apkdir):
-            print(
-                "\n[~] WARNING: Detected ProGuard/AndResGuard, decompile/recompile may not succeed.\n"
-            )
+            # Record the destination paths of all but the base APK
+            if apkpath != baseapk:
+                splitapkpaths.append(apkdir)
+            else:
+                baseapkdir = apkdir
     print("")
 
-    myFixPublicResourcesIds3(baseapkdir, splitapkpaths)
+    # Every phase below changes the decoded folders, its key chains the one of the phase before
+    key = hashOf("resources", sorted(decodeKeys.values()), deterministic)
+
+    # Smali of the base as decoded, patched folders are assembled again, the others reuse the original dex
+    if patch is not None:
+        import patcher
+
+        smaliSnapshot = checkpoints.get("smaliSnapshot")
+        if smaliSnapshot is None or not checkpoints.done("resources", key):
+            smaliSnapshot = patcher.snapshot_smali(baseapkdir)
+            checkpoints.put("smaliSnapshot", smaliSnapshot)
+
+    if not checkpoints.skip("resources", key):
+        with checkpoints.phase("resources", key), perf_history.phase("resources"):
+            myFixPublicResourcesIds3(baseapkdir, splitapkpaths)
+
+            if deterministic:
+                sortPublicXml(os.path.join(baseapkdir, "res", "values", "public.xml"))
 
     # Walk the extracted APK directories and copy files and directories to the base APK
-    copySplitApkFiles(baseapkdir, splitapkpaths)
+    key = hashOf("copy", key)
+    if not checkpoints.skip("copy", key):
+        with checkpoints.phase("copy", key), perf_history.phase("copy"):
+            copySplitApkFiles(baseapkdir, splitapkpaths)
 
     # # Fix public resource identifiers
     # myFixPublicResourcesIds2(baseapkdir, splitapkpaths)
 
     # # Hack: Delete duplicate style resource entries.
-    if disableStylesHack == False:
-        hackRemoveDuplicateStyleEntries(baseapkdir)
+    key = hashOf("styles", key, disableStylesHack)
+    if not checkpoints.skip("styles", key):
+        with checkpoints.phase("styles", key):
+            if disableStylesHack == False:
+                hackRemoveDuplicateStyleEntries(baseapkdir)
 
     # fixDuplicatePublicIds(baseapkdir)
 
     # # Disable APK splitting in the base AndroidManifest.xml file
-    disableApkSplitting(baseapkdir)
+    key = hashOf("manifest", key)
+    if not checkpoints.skip("manifest", key):
+        with checkpoints.phase("manifest", key):
+            disableApkSplitting(baseapkdir)
+
+    # Patch the merged tree, saves decoding and building the APK again in patcher.py
+    key = hashOf("patch", key, inspect.getsource(patch) if patch is not None else None)
+    if patch is not None and not checkpoints.skip("patch", key):
+        with checkpoints.phase("patch", key):
+            print("Patching the base APK.")
+            with perf_history.phase("patch"):
+                patch(baseapkdir)
+            with perf_history.phase("assemble"):
+                patcher.reuse_unchanged_dex(baseapk, baseapkdir, smaliSnapshot, currentOptions.get().heap_mb)
+            print("")
+
+    key = hashOf("build", key, dest, deterministic, validate, strictValidate)
+    if not checkpoints.skip("build", key, dest):
+        # the build only writes the apk, a failed one is the only phase run again
+        with checkpoints.phase("build", key, mutates=False):
+            # Dangling references and id conflicts fail here instead of minutes later in aapt
+            if validate:
+                with perf_history.phase("validate"):
+                    problems = resource_check.validateResources(baseapkdir)
+                for problem in problems:
+                    dbgPrint("[-] " + str(problem))
+                failing = resource_check.errors(problems, strictValidate)
+                if failing:
+                    raise MergeError(
+                        f"{len(failing)} resource problems in the merged tree, first: {failing[0]}"
+                        + "\nRun with --debug-output for all of them, or --no-validate to build anyway."
+                    )
+                elif problems:
+                    print(f"[-] {len(problems)} unresolved resource references, see --debug-output")
+
+            # Rebuild the base APK
+            print("Rebuilding as a single APK.")
+            with perf_history.phase("build"):
+                buildApk(baseapkdir, dest)
+
+            if deterministic:
+                with perf_history.phase("normalize"):
+                    normalize_apk(dest)
+
+    # Return the new APK path
+    return os.path.join(baseapkdir, "dist", baseapkfilename)
 
-    # Rebuild the base APK
-    print("Rebuilding as a single APK.")
+
+####################
+# apktool b of the merged tree
+####################
+def buildApk(baseapkdir, dest):
     if os.path.exists(os.path.join(baseapkdir, "res", "navigation")) == True:
         print(
             "[+] Found res/navigation directory, rebuilding with 'apktool --use-aapt2'."
         )
-        ret = runApkTool(["b", "--use-aapt2", "-o", dest, baseapkdir])
+        ret = runApkTool(["b"] + aapt2Args() + ["-o", dest, baseapkdir])
         if ret.returncode != 0:
-            print(
-                "Error: Failed to run 'apktool b "
+            raise MergeError(
+                "Failed to run 'apktool b "
                 + baseapkdir
                 + "'.\nRun with --debug-output for more information."
             )
-            sys.exit(1)
-    elif getApktoolVersion() > pkg_resources.parse_version("2.4.2"):
+    elif getApktoolVersion() > parseVersion("2.4.2"):
         print(
             "[+] Found apktool version > 2.4.2, rebuilding with 'apktool --use-aapt2'."
         )
-        ret = runApkTool(["b", "--use-aapt2", "-o", dest, baseapkdir])
+        ret = runApkTool(["b"] + aapt2Args() + ["-o", dest, baseapkdir])
         if ret.returncode != 0:
-            print(
-                "Error: Failed to run 'apktool b "
+            raise MergeError(
+                "Failed to run 'apktool b "
                 + baseapkdir
                 + "'.\nRun with --debug-output for more information."
             )
-            sys.exit(1)
     else:
         print("[+] Building APK with apktool.")
         ret = runApkTool(["b", "-o", dest, baseapkdir])
         if ret.returncode != 0:
-            print(
-                "Error: Failed to run 'apktool b "
+            raise MergeError(
+                "Failed to run 'apktool b "
                 + baseapkdir
                 + "'.\nRun with --debug-output for more information."
             )
-            sys.exit(1)
-
-    # Return the new APK path
-    return os.path.join(baseapkdir, "dist", baseapkfilename)
 
 
 def fixDuplicatePublicIds(baseapkdir):
@@ -351,6 +771,41 @@ def detectProGuard(extractedPath):
     return False
 
 
+####################
+# Sort public.xml by type and id, so the merged file does not depend on the order of the splits.
+####################
+def sortPublicXml(publicXml):
+    import xml_backend
+
+    if not os.path.exists(publicXml):
+        return
+    doc = xml_backend.parse(publicXml)
+    root = doc.root
+    elements = list(xml_backend.childElements(root))
+    elements.sort(key=lambda el: (el.attrib.get("type", ""), int(el.attrib.get("id", "0"), 16), el.attrib.get("name", "")))
+    root[:] = elements
+    root.text = "\n    "
+    for el in elements:
+        el.tail = "\n    "
+    if elements:
+        elements[-1].tail = "\n"
+    doc.write()
+
+
+####################
+# Next free classesN.dex name in a decoded APK directory (classes.dex, classes2.dex, ...)
+####################
+DEX_RE = re.compile(r"^classes(\d*)\.dex$")
+
+
+def nextDexName(apkdir):
+    used = [DEX_RE.match(f) for f in os.listdir(apkdir)]
+    indexes = [int(m.group(1) or 1) for m in used if m]
+    if not indexes:
+        return "classes.dex"
+    return f"classes{max(indexes) + 1}.dex"
+
+
 ####################
 # Copy files and directories from split APKs into the base APK directory.
 ####################
@@ -383,6 +838,10 @@ def copySplitApkFiles(baseapkdir, splitapkpaths):
                     # Translate path to base APK
                     p = baseapkdir + os.path.join(root, f)[len(apkdir) :]
 
+                    # Dex files kept as is (apktool d -s) are added as the next classesN.dex of the base APK
+                    if apkdir == root and DEX_RE.match(f):
+                        p = os.path.join(baseapkdir, nextDexName(baseapkdir))
+
                     # Copy files into the base APK, except for XML files in the res directory
                     if f.lower().endswith(".xml") and p.startswith(
                         os.path.join(baseapkdir, "res")
@@ -392,64 +851,123 @@ def copySplitApkFiles(baseapkdir, splitapkpaths):
                     shutil.move(os.path.join(root, f), p)
     print("")
 
-from dataclasses import dataclass
+####################
+# Compact table of the resources declared in a public.xml, shared by the public id
+# reconciliation, the additions to the base public.xml and the reference rewrite.
+# -> ids are parsed once from hex into ints
+# -> resource types are interned into small int codes shared by every table
+# -> lookups use int and tuple keys, no string formatting per lookup
+####################
+RESOURCE_TYPE_CODES = {}
+RESOURCE_TYPE_NAMES = []
+# merges run in threads (scheduler, merge_splits callers), a new type gets its code under the lock
+RESOURCE_TYPE_LOCK = threading.Lock()
+
 
-@dataclass
-class DummyResource:
-    dummyName: str
-    res_type: str
-    res_id: str
-    realName: str = None
+def resTypeCode(res_type):
+    code = RESOURCE_TYPE_CODES.get(res_type)
+    if code is None:
+        with RESOURCE_TYPE_LOCK:
+            code = RESOURCE_TYPE_CODES.get(res_type)
+            if code is None:
+                code = len(RESOURCE_TYPE_NAMES)
+                RESOURCE_TYPE_NAMES.append(sys.intern(res_type))
+                RESOURCE_TYPE_CODES[res_type] = code
+    return code
 
-@dataclass
-class RenameResource:
-    res_name_from: str
-    res_name_to: str
-    res_type: str
 
-class DummyResources:
+class Resource:
+    __slots__ = ("name", "type_code", "res_id", "real_name")
+
+    def __init__(self, name, type_code, res_id):
+        self.name = name
+        self.type_code = type_code
+        self.res_id = res_id
+        self.real_name = None
 
+    @property
+    def res_type(self):
+        return RESOURCE_TYPE_NAMES[self.type_code]
+
+    @property
+    def hex_id(self):
+        return f"0x{self.res_id:08x}"
+
+
+class ResourceTable:
     def __init__(self):
-        self.store = []
+        self.by_id = {}
+        self.by_name = {}
+
+    @classmethod
+    def fromPublicXml(cls, publicXml):
+        import xml_backend
+
+        table = cls()
+        for el in xml_backend.iterElements(publicXml, "public"):
+            attrib = el.attrib
+            if "name" in attrib and "id" in attrib and "type" in attrib:
+                table.add(attrib["name"], attrib["type"], attrib["id"])
+        return table
+
+    def add(self, name, res_type, res_id):
+        r = Resource(sys.intern(name), resTypeCode(res_type), int(res_id, 16))
+        self.by_id[r.res_id] = r
+        self.by_name[(r.type_code, r.name)] = r
+        return r
+
+    def findById(self, res_id):
+        return self.by_id.get(res_id)
+
+    def findByName(self, res_type, name):
+        code = RESOURCE_TYPE_CODES.get(res_type)
+        if code is None:
+            return None
+        return self.by_name.get((code, name))
 
-    def addFromBase(self, dummyName, res_type, res_id):
-        r = DummyResource(dummyName, res_type, res_id)
-        self.store.append(r)
+    def getItemsWithRealName(self):
+        return [r for r in self.by_id.values() if r.real_name]
 
-    def buildCacheById(self):
-        self.cache_by_id = {f'{r.res_type}---{r.res_id}':r for r in self.store}
+    def __iter__(self):
+        return iter(self.by_id.values())
 
-    def buildCacheByDummyName(self):
-        self.cache_by_dummyName = {f'{r.res_type}---{r.dummyName}':r for r in self.store}
+    def __len__(self):
+        return len(self.by_id)
 
 
-    def findById(self, res_type, res_id):
-        if not hasattr(self, 'cache_by_id'):
-            self.buildCacheById()
+####################
+# Resource renames (type, old name) -> new name to apply to the references of a decoded APK.
+####################
+class ResourceRenames:
+    def __init__(self):
+        self.renames = {}
 
-        return self.cache_by_id[f'{res_type}---{res_id}']
+    def add(self, type_code, name_from, name_to):
+        self.renames[(type_code, name_from)] = name_to
 
-    def findByDummyName(self, res_type, dummyName):
-        if not hasattr(self, 'cache_by_dummyName'):
-            self.buildCacheByDummyName()
+    def get(self, res_type, name):
+        code = RESOURCE_TYPE_CODES.get(res_type)
+        if code is None:
+            return None
+        return self.renames.get((code, name))
 
-        return self.cache_by_dummyName.get(f'{res_type}---{dummyName}')
+    def __len__(self):
+        return len(self.renames)
 
-    def getItemsWithRealName(self):
-        return [r for r in self.store if r.realName ]
 
 def myFixPublicResourcesIds3(baseapkdir, splitapkpaths):
+    import perf_history
+    import xml_backend
+
     basePublicXml = Path(baseapkdir) / "res" / "values" / "public.xml"
 
     ## cache ids in the public.xml of the base
-    ids_in_base_public = {}
-    baseXmlTree = xml.etree.ElementTree.parse(basePublicXml)
-    for el in baseXmlTree.getroot():
-        if "name" in el.attrib and "id" in el.attrib and "type" in el.attrib:
-            ids_in_base_public[el.attrib['id']] = DummyResource(el.attrib['name'], el.attrib['type'], el.attrib['id'])
-
+    base = ResourceTable.fromPublicXml(basePublicXml)
+    # new resources of every split are added to it, written once at the end
+    basePublic = xml_backend.parse(basePublicXml)
+    added = 0
 
-    base_renames = []
+    base_renames = ResourceRenames()
     for splitPath in splitapkpaths:
         print(f"Processing {splitPath}....")
 
@@ -465,35 +983,27 @@ def myFixPublicResourcesIds3(baseapkdir, splitapkpaths):
         to_modify = []
         to_not_modify = []
 
-        baseXmlTree = xml.etree.ElementTree.parse(publicXml)
-        for el in baseXmlTree.iter():
-            if "id" in el.attrib and "name" in el.attrib and "type" in el.attrib:
-                res_id = el.attrib['id']
-                res_name = el.attrib['name']
-
-                if res_id not in ids_in_base_public:
-                    to_add.append(el)
-                else:
-                    res = ids_in_base_public[res_id]
+        for res in ResourceTable.fromPublicXml(publicXml):
+            base_res = base.findById(res.res_id)
 
-                    if res.dummyName == res_name:
-                        to_not_modify.append(el)
-                    else:
-                        to_modify.append(el)
+            if base_res is None:
+                to_add.append(res)
+            elif base_res.name == res.name:
+                to_not_modify.append(res)
+            else:
+                to_modify.append((res, base_res))
 
-        add_elements_to_base_public(basePublicXml, splitPath, to_add)
+        add_elements_to_base_public(basePublic, to_add)
+        added += len(to_add)
 
-        split_rename = []
+        split_rename = ResourceRenames()
 
         ## Some validations...
-        for el in to_modify:
-            res_id = el.attrib['id']
-            split_name = el.attrib['name']
-            split_type = el.attrib['type']
-            base_name = ids_in_base_public[res_id].dummyName
-            base_type = ids_in_base_public[res_id].res_type
-
-            if split_type != base_type:
+        for res, base_res in to_modify:
+            split_name = res.name
+            base_name = base_res.name
+
+            if res.type_code != base_res.type_code:
                 raise Exception("Assumption: internal ids are not shared between types")
             
             if "APKTOOL_DUMMY" not in split_name and "APKTOOL_DUMMY" not in base_name:
@@ -501,13 +1011,13 @@ def myFixPublicResourcesIds3(baseapkdir, splitapkpaths):
             if "APKTOOL_DUMMY" in split_name and "APKTOOL_DUMMY" in base_name:
                 raise Exception("Assumption: Both resource rename cannot be dummies")
                 
-            # print(f"res_id {res_id} split: {split_type} {split_name} base: {base_type} {base_name}")
+            # print(f"res_id {res.hex_id} split: {res.res_type} {split_name} base: {base_res.res_type} {base_name}")
 
             
             if "APKTOOL_DUMMY" in split_name:
-                split_rename.append(RenameResource(split_name, base_name, split_type))
+                split_rename.add(res.type_code, split_name, base_name)
             if "APKTOOL_DUMMY" in base_name:
-                base_renames.append(RenameResource(base_name, split_name, base_type))
+                base_renames.add(base_res.type_code, base_name, split_name)
 
 
 
@@ -518,62 +1028,49 @@ def myFixPublicResourcesIds3(baseapkdir, splitapkpaths):
         print(f"Replacing in {splitPath} {len(split_rename)} changes")
         replace_in_path(Path(splitPath), split_rename)
 
+    basePublic.write()
+    perf_history.record(resources=len(base) + added)
+
     print(f"Replacing in {splitPath} {len(base_renames)} changes")
     replace_in_path(Path(baseapkdir), base_renames)
 
 def replace_in_path(path, renames):
+    import xml_backend
+
     if not renames:
         return
 
-    rename_cache = {f"@{res_rename.res_type}/{res_rename.res_name_from}":res_rename.res_name_to for res_rename in renames}
-
     updated = 0
     files = path.rglob("res/**/*.xml")
     for f in files:
         try:
             # Load the XML
             dbgPrint(f"[~] Parsing {f}")
-            tree = xml.etree.ElementTree.parse(f)
-
-            # Register the namespaces and get the prefix for the "android" namespace
-            namespaces = dict(
-                [
-                    node
-                    for _, node in xml.etree.ElementTree.iterparse(
-                        path / "AndroidManifest.xml",
-                        events=["start-ns"],
-                    )
-                ]
-            )
-            for ns in namespaces:
-                xml.etree.ElementTree.register_namespace(ns, namespaces[ns])
-            ns = "{" + namespaces["android"] + "}"
+            doc = xml_backend.parse(f)
 
             changed = False
-            for el in tree.iter():
-                for attr in el.attrib:
-                    val = el.attrib[attr]
+            for el in doc.elements():
+                attrib = el.attrib
+                for attr in attrib:
+                    val = attrib[attr]
 
                     if (
                         val.startswith("@")
                         and "/" in val
                     ):
-                        res_type = val.split("/")[0][1:]
-                        dummyName = val.split("/")[1]
-                        k = f"@{res_type}/{dummyName}"
-                        
-                        if k in rename_cache:
-                            el.attrib[attr] = val.replace(dummyName, rename_cache[k])
+                        res_type, _, name = val[1:].partition("/")
+                        new_name = renames.get(res_type, name)
+
+                        if new_name is not None:
+                            attrib[attr] = val.replace(name, new_name)
                             updated += 1
                             changed = True
 
-                    elif "type" in el.attrib:
-                        res_type = el.attrib['type']
-                        dummyName = val
-                        k = f"@{res_type}/{dummyName}"
+                    elif "type" in attrib:
+                        new_name = renames.get(attrib['type'], val)
 
-                        if k in rename_cache:
-                            el.attrib[attr] = val.replace(dummyName, rename_cache[k])
+                        if new_name is not None:
+                            attrib[attr] = new_name
                             updated += 1
                             changed = True
                         
@@ -586,27 +1083,22 @@ def replace_in_path(path, renames):
                     and "/" in val
                     # and dummyNameToRealName[val.split("/")[1]] is not None
                 ):
-                    res_type = val.split("/")[0][1:]
-                    dummyName = val.split("/")[1]
-                    k = f"@{res_type}/{dummyName}"
+                    res_type, _, name = val[1:].partition("/")
+                    new_name = renames.get(res_type, name)
 
-                    if k in rename_cache:
-                        el.text = val.replace(dummyName, rename_cache[k])
+                    if new_name is not None:
+                        el.text = val.replace(name, new_name)
                         updated += 1
                         changed = True
 
             # Save the file if it was updated
             if changed == True:
                 print(f"changed {f}")
-                tree.write(
-                    f,
-                    encoding="utf-8",
-                    xml_declaration=True,
-                )
-        except xml.etree.ElementTree.ParseError:
+                doc.write()
+        except xml_backend.ParseError:
             print(
                 "[-] XML parse error in "
-                + f
+                + str(f)
                 + ", skipping."
             )
     print(
@@ -617,25 +1109,18 @@ def replace_in_path(path, renames):
     print("")
  
 
-def add_elements_to_base_public(basePublicXml, apk_path, elements_to_add):
-    baseXmlTree = xml.etree.ElementTree.parse(basePublicXml)
-    rootXml = baseXmlTree.getroot()
-
-    for el in elements_to_add:
-        name = el.attrib['name']
-        res_type = el.attrib['type']
-        res_id = el.attrib['id']
-
-        element = ET.Element("public")
-        element.attrib['name'] = name
-        element.attrib['id'] = res_id
-        element.attrib['type'] = res_type
-        element.attrib['f'] = apk_path
+def add_elements_to_base_public(basePublic, resources_to_add):
+    import xml_backend
+
+    rootXml = basePublic.root
+
+    for res in resources_to_add:
+        element = xml_backend.makeElement(
+            rootXml, "public", {"name": res.name, "id": res.hex_id, "type": res.res_type}
+        )
         element.tail = "\n"                      # Edit the element's tail
 
         rootXml.insert(0, element)
-
-    baseXmlTree.write(basePublicXml,encoding="utf-8", xml_declaration=True)
         
 
 
@@ -735,14 +1220,10 @@ def myFixPublicResourcesIds(baseapkdir, splitapkpaths):
     if not basePublicXml.exists():
         return
 
-    resources = DummyResources()
-
+    resources = ResourceTable.fromPublicXml(basePublicXml)
     baseXmlTree = xml.etree.ElementTree.parse(basePublicXml)
-    for el in baseXmlTree.getroot():
-        if "name" in el.attrib and "id" in el.attrib and "type" in el.attrib:
-            resources.addFromBase(el.attrib['name'], el.attrib['type'], el.attrib['id'])
             
-    print(f"[+] KZK Resolving {len(resources.store)} resource identifiers.")
+    print(f"[+] KZK Resolving {len(resources)} resource identifiers.")
 
 
     for splitdir in splitapkpaths:
@@ -751,17 +1232,17 @@ def myFixPublicResourcesIds(baseapkdir, splitapkpaths):
             tree = xml.etree.ElementTree.parse(publicXml)
             for el in tree.getroot():
                 if "name" in el.attrib and "id" in el.attrib and "type" in el.attrib:
-                    r = resources.findById(el.attrib['type'], el.attrib['id'])
-                    r.realName = el.attrib["name"]
+                    r = resources.findById(int(el.attrib['id'], 16))
+                    r.real_name = el.attrib["name"]
 
     print(f"[+] KZK Located {len(resources.getItemsWithRealName())} true resource names.")
     
     updated = 0
     for el in baseXmlTree.getroot():
         if "name" in el.attrib and "id" in el.attrib and "type" in el.attrib:
-            r = resources.findByDummyName(el.attrib['type'], el.attrib['name'])
-            if r.realName:
-                el.attrib["name"] = r.realName
+            r = resources.findByName(el.attrib['type'], el.attrib['name'])
+            if r.real_name:
+                el.attrib["name"] = r.real_name
                 updated += 1
     baseXmlTree.write(basePublicXml,encoding="utf-8", xml_declaration=True,
     )
@@ -810,20 +1291,20 @@ def myFixPublicResourcesIds(baseapkdir, splitapkpaths):
                         res_type = val.split("/")[0][1:]
                         dummyName = val.split("/")[1]
 
-                        r = resources.findByDummyName(res_type, dummyName)
+                        r = resources.findByName(res_type, dummyName)
 
-                        if r and r.realName:
-                            el.attrib[attr] = val.replace(dummyName, r.realName)
+                        if r and r.real_name:
+                            el.attrib[attr] = val.replace(dummyName, r.real_name)
                             updated += 1
                             changed = True
                     elif val.startswith("APKTOOL_DUMMY_") and "type" in el.attrib:
                         res_type = el.attrib['type']
                         dummyName = val
 
-                        r = resources.findByDummyName(res_type, dummyName)
+                        r = resources.findByName(res_type, dummyName)
 
-                        if r and r.realName:
-                            el.attrib[attr] = val.replace(dummyName, r.realName)
+                        if r and r.real_name:
+                            el.attrib[attr] = val.replace(dummyName, r.real_name)
                             updated += 1
                             changed = True
                     elif (
@@ -844,10 +1325,10 @@ def myFixPublicResourcesIds(baseapkdir, splitapkpaths):
                     res_type = val.split("/")[0][1:]
                     dummyName = val.split("/")[1]
 
-                    r = resources.findByDummyName(res_type, dummyName)
+                    r = resources.findByName(res_type, dummyName)
 
-                    if r and r.realName:
-                        el.text = val.replace(dummyName, r.realName)
+                    if r and r.real_name:
+                        el.text = val.replace(dummyName, r.real_name)
                         updated += 1
                         changed = True
 
@@ -1049,6 +1530,8 @@ def fixPublicResourceIDs(baseapkdir, splitapkpaths):
 # This hack parses res/values/styles.xml, finds all offending elements, removes them, then saves the result.
 ####################
 def hackRemoveDuplicateStyleEntries(baseapkdir):
+    import xml_backend
+
     # Bail if there is no styles.xml
     if os.path.exists(os.path.join(baseapkdir, "res", "values", "styles.xml")) == False:
         return
@@ -1063,12 +1546,10 @@ def hackRemoveDuplicateStyleEntries(baseapkdir):
     dupes = []
 
     # Parse styles.xml and find all <item> elements with duplicate names
-    tree = xml.etree.ElementTree.parse(
-        os.path.join(baseapkdir, "res", "values", "styles.xml")
-    )
-    for styleEl in tree.getroot().findall("style"):
+    doc = xml_backend.parse(os.path.join(baseapkdir, "res", "values", "styles.xml"))
+    for styleEl in doc.root.findall("style"):
         itemNames = []
-        for itemEl in styleEl:
+        for itemEl in xml_backend.childElements(styleEl):
             if "name" in itemEl.attrib and itemEl.attrib["name"] in itemNames:
                 dupes.append([styleEl, itemEl])
             else:
@@ -1080,11 +1561,7 @@ def hackRemoveDuplicateStyleEntries(baseapkdir):
 
     # Save the result if any duplicates were found and removed
     if len(dupes) > 0:
-        tree.write(
-            os.path.join(baseapkdir, "res", "values", "styles.xml"),
-            encoding="utf-8",
-            xml_declaration=True,
-        )
+        doc.write()
         print("[+] Removed " + str(len(dupes)) + " duplicate entries from styles.xml.")
     print("")
 
@@ -1096,28 +1573,18 @@ def hackRemoveDuplicateStyleEntries(baseapkdir):
 # -> Removes meta-data elements with the name "com.android.vending.splits" or "com.android.vending.splits.required"
 ####################
 def disableApkSplitting(baseapkdir):
+    import xml_backend
+
     print("Disabling APK splitting in AndroidManifest.xml of base APK.")
 
-    # Load AndroidManifest.xml
-    tree = xml.etree.ElementTree.parse(os.path.join(baseapkdir, "AndroidManifest.xml"))
-
-    # Register the namespaces and get the prefix for the "android" namespace
-    namespaces = dict(
-        [
-            node
-            for _, node in xml.etree.ElementTree.iterparse(
-                os.path.join(baseapkdir, "AndroidManifest.xml"), events=["start-ns"]
-            )
-        ]
-    )
-    for ns in namespaces:
-        xml.etree.ElementTree.register_namespace(ns, namespaces[ns])
-    ns = "{" + namespaces["android"] + "}"
+    # Load AndroidManifest.xml and get the prefix for the "android" namespace
+    doc = xml_backend.parse(os.path.join(baseapkdir, "AndroidManifest.xml"))
+    ns = doc.ns("android")
 
     # Disable APK splitting
     appEl = None
     elsToRemove = []
-    for el in tree.iter():
+    for el in doc.elements():
         if el.tag == "application":
             appEl = el
             if ns + "isSplitRequired" in el.attrib:
@@ -1137,11 +1604,7 @@ def disableApkSplitting(baseapkdir):
         appEl.remove(el)
 
     # Save the updated AndroidManifest.xml
-    tree.write(
-        os.path.join(baseapkdir, "AndroidManifest.xml"),
-        encoding="utf-8",
-        xml_declaration=True,
-    )
+    doc.write()
     print("")
 
 
@@ -0,0 +1,116 @@
+####################
+# Checkpoints of the merge phases, kept in <input folder>/merge-checkpoint.json by the merges run
+# with --resume, so the next one skips what the last one finished (e.g. only the build is run again
+# after it failed). A merge without --resume writes nothing and removes the file of an older one.
+# -> every phase is recorded with a key: the hash of its inputs, chained with the keys of the
+#    phases it works on, a phase whose key changed runs again and so does every phase after it
+# -> a phase that changes the decoded folders is marked as running until it ends, if a merge
+#    stops in the middle of one the folders are in an unknown state and the next one starts over
+####################
+import functools
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+CHECKPOINT_FILE = "merge-checkpoint.json"
+# prefix of the phases decoding an apk, every other phase works on the decoded folders
+DECODE = "decode "
+
+
+def hashOf(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _fileDigest(path, size, mtime):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fileDigest(path):
+    stat = os.stat(path)
+    return _fileDigest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class Checkpoints:
+    def __init__(self, folder=None, resume=False):
+        # no folder: nothing is recorded or skipped
+        self.path = os.path.join(folder, CHECKPOINT_FILE) if folder is not None else None
+        if self.path is not None and not resume:
+            # this merge changes the decoded folders, a later --resume can't trust the file
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.path = None
+        self.state = {"phases": [], "running": None, "data": {}}
+        if self.path is None:
+            return
+        if resume and os.path.exists(self.path):
+            with open(self.path) as fh:
+                self.state = json.load(fh)
+            if self.state["running"] is not None:
+                print(f"[~] The last merge stopped during {self.state['running']}, starting over.")
+                self.state = {"phases": [], "running": None, "data": {}}
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump(self.state, fh, indent=2)
+        os.replace(tmp, self.path)
+
+    def done(self, name, key, *outputs):
+        """True if the phase finished with the same key and its outputs are still there."""
+        return [name, key] in self.state["phases"] and all(os.path.exists(o) for o in outputs)
+
+    def skip(self, name, key, *outputs):
+        if not self.done(name, key, *outputs):
+            return False
+        print(f"[=] {name}: done by the last merge, skipping.")
+        return True
+
+    def pastDecode(self):
+        return any(not name.startswith(DECODE) for name, _ in self.state["phases"])
+
+    def keepDecodes(self, decodes):
+        """
+        decodes: phase -> (key, folder) of every apk to merge. Unless all of
+        them are still valid every phase is done again, the phases after the
+        decode changed the folders of the apks that did not change.
+        """
+        if self.pastDecode() and not all(self.done(name, key, folder) for name, (key, folder) in decodes.items()):
+            self.state["phases"] = []
+            self.save()
+
+    @contextmanager
+    def phase(self, name, key, mutates=True):
+        names = [n for n, _ in self.state["phases"]]
+        if name.startswith(DECODE) and self.pastDecode():
+            # the other decoded folders were changed by the phases after the decode too
+            self.state["phases"] = []
+        elif name in names:
+            # this phase and every phase recorded after it are not valid anymore
+            del self.state["phases"][names.index(name) :]
+        if mutates:
+            self.state["running"] = name
+        self.save()
+        yield
+        self.state["running"] = None
+        self.state["phases"].append([name, key])
+        self.save()
+
+    def get(self, name):
+        return self.state["data"].get(name)
+
+    def put(self, name, value):
+        self.state["data"][name] = value
+        self.save()
@@ -0,0 +1,177 @@
+import contextlib
+import fcntl
+import os
+import re
+import socket
+import threading
+import time
+
+# textfile collector directory of the node exporter (--collector.textfile.directory),
+# nothing is written when it is not set
+METRICS_DIR = os.environ.get("METRICS_TEXTFILE_DIR")
+METRICS_FILE = "apk_pipeline.prom"
+PREFIX = "apk_pipeline_"
+
+METRICS = {
+    "stage_runs_total": ("counter", "Runs of a stage (download, merge, patch, sign, repo), failed ones included."),
+    "stage_failures_total": ("counter", "Runs of a stage that failed."),
+    "stage_seconds_total": ("counter", "Time spent in a stage."),
+    "stage_last_seconds": ("gauge", "Duration of the last run of a stage."),
+    "stage_last_success_timestamp_seconds": ("gauge", "When a stage last succeeded."),
+    "apps_processed_total": ("counter", "Apps a stage went through successfully."),
+    "jvm_in_flight": ("gauge", "JVM processes (downloader, apktool, smali, signer) running, by the process that started them."),
+    "downloaded_bytes_total": ("counter", "Size of the apks downloaded."),
+    "cache_hits_total": ("counter", "Cache lookups that found an entry (aapt2 compiled resources, signed apks)."),
+    "cache_misses_total": ("counter", "Cache lookups that did not find an entry."),
+}
+
+_lock = threading.Lock()
+# series -> ("add" | "set", value), not written yet
+_pending = {}
+# JVMs this process started and that are still running
+_jvms = 0
+HOST = socket.gethostname()
+JVM_SERIES_RE = re.compile(r'^' + PREFIX + r'jvm_in_flight\{host="([^"]*)",pid="(\d+)"\}$')
+
+
+def series(name, labels):
+    if not labels:
+        return PREFIX + name
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for v in labels.values())
+    return PREFIX + name + "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def inc(name, value=1, **labels):
+    key = series(name, labels)
+    with _lock:
+        _, current = _pending.get(key, ("add", 0))
+        _pending[key] = ("add", current + value)
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _pending[series(name, labels)] = ("set", value)
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def drop_dead_jvms(values):
+    # a process killed while its JVM ran never sets its gauge back to 0,
+    # the gauges of the processes of this host that are gone are removed
+    for key in list(values):
+        match = JVM_SERIES_RE.match(key)
+        if match and match.group(1) == HOST and (values[key] == 0 or not alive(int(match.group(2)))):
+            del values[key]
+
+
+def read(path):
+    values = {}
+    if not os.path.exists(path):
+        return values
+    with open(path) as fh:
+        for line in fh:
+            if line.startswith("#") or not line.strip():
+                continue
+            key, value = line.rsplit(" ", 1)
+            values[key] = float(value)
+    return values
+
+
+def write(path, values):
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        family = sorted(k for k in values if k == PREFIX + name or k.startswith(PREFIX + name + "{"))
+        if not family:
+            continue
+        lines += [f"# HELP {PREFIX}{name} {description}", f"# TYPE {PREFIX}{name} {kind}"]
+        lines += [f"{key} {values[key]!r}" for key in family]
+    # the collector must never see a half written file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def flush():
+    """
+    Add the pending values to the metrics file. Every tool (and the aapt2
+    wrapper, started many times by apktool) updates the same file under a
+    lock, so the counters add up over the processes of a batch.
+    """
+    global _pending
+    if not METRICS_DIR:
+        return
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, METRICS_FILE)
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            values = read(path)
+            for key, (op, value) in pending.items():
+                values[key] = value if op == "set" else values.get(key, 0) + value
+            drop_dead_jvms(values)
+            write(path, values)
+    except (OSError, ValueError) as e:
+        # metrics are never a reason to fail a run
+        print(f"[-] could not write the metrics: {e}")
+
+
+def record_stage(name, seconds, ok, apps=1):
+    inc("stage_runs_total", stage=name)
+    inc("stage_seconds_total", seconds, stage=name)
+    set_gauge("stage_last_seconds", seconds, stage=name)
+    if ok:
+        inc("apps_processed_total", apps, stage=name)
+        set_gauge("stage_last_success_timestamp_seconds", time.time(), stage=name)
+    else:
+        inc("stage_failures_total", stage=name)
+    flush()
+
+
+@contextlib.contextmanager
+def stage(name, apps=1):
+    """Count a run of a stage, its duration and whether it failed."""
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record_stage(name, time.perf_counter() - start, ok, apps)
+
+
+def jvm_count(delta):
+    global _jvms
+    with _lock:
+        _jvms += delta
+        # a gauge per process instead of a shared sum, see drop_dead_jvms()
+        _pending[series("jvm_in_flight", {"host": HOST, "pid": os.getpid()})] = ("set", _jvms)
+    flush()
+
+
+@contextlib.contextmanager
+def jvm():
+    """A JVM is running for the duration of the block."""
+    jvm_count(1)
+    try:
+        yield
+    finally:
+        jvm_count(-1)
+
+
+def cache_lookups(cache, hits, misses):
+    inc("cache_hits_total", hits, cache=cache)
+    inc("cache_misses_total", misses, cache=cache)
+    flush()
@@ -0,0 +1,253 @@
+import click
+import contextvars
+import os
+import resource
+import sqlite3
+import statistics
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+PERF_HISTORY = os.environ.get("PERF_HISTORY", "perf_history.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    tool TEXT NOT NULL,
+    package TEXT,
+    version_code INTEGER,
+    started REAL NOT NULL,
+    splits INTEGER,
+    resources INTEGER,
+    peak_memory_mb REAL,
+    output_size INTEGER,
+    ok INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_package ON runs(tool, package, started);
+"""
+
+# Recorder of the run going on in the current thread, see phase() and record()
+currentRun = contextvars.ContextVar("currentRun", default=None)
+
+
+def connect(db=None):
+    conn = sqlite3.connect(str(db or PERF_HISTORY), timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def own_peak_kb():
+    # lifetime max rss of the interpreter, KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PerfRun:
+    """
+    Durations and sizes of one run of a tool on a package, appended to the
+    history when the run ends. Fields unknown to the tool stay NULL.
+    """
+
+    def __init__(self, tool, package=None, db=None):
+        self.tool = tool
+        self.db = db
+        self.started = time.time()
+        self.fields = {"package": package}
+        self.phases = []
+        # the interpreter runs many packages (pipeline, work_queue.py workers),
+        # its max rss only belongs to this run if it grew during it
+        self.own_peak_before = own_peak_kb()
+        self.children_peak_kb = 0
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def record(self, **fields):
+        self.fields.update(fields)
+
+    def record_child(self, max_rss_kb):
+        self.children_peak_kb = max(self.children_peak_kb, max_rss_kb)
+
+    def peak_memory_mb(self):
+        """Max rss of the biggest child (apktool, downloader...) of the run, or of the interpreter if it grew."""
+        own = own_peak_kb()
+        peak = max(own if own > self.own_peak_before else 0, self.children_peak_kb)
+        return peak / 1024 if peak else None
+
+    def save(self, ok):
+        self.phases.append(("total", time.time() - self.started))
+        try:
+            with connect(self.db) as conn:
+                cur = conn.execute(
+                    "INSERT INTO runs (tool, package, version_code, started, splits, resources, peak_memory_mb, output_size, ok)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        self.tool,
+                        self.fields.get("package"),
+                        self.fields.get("version_code"),
+                        self.started,
+                        self.fields.get("splits"),
+                        self.fields.get("resources"),
+                        self.peak_memory_mb(),
+                        self.fields.get("output_size"),
+                        int(ok),
+                    ),
+                )
+                conn.executemany(
+                    "INSERT INTO phases (run_id, phase, seconds) VALUES (?, ?, ?)",
+                    [(cur.lastrowid, name, seconds) for name, seconds in self.phases],
+                )
+            conn.close()
+        except sqlite3.Error as e:
+            # the history is never a reason to fail a run
+            print(f"[-] could not save the performance history: {e}")
+
+
+@contextmanager
+def run(tool, package=None, db=None):
+    """Record a run, the tool reports phases and fields with phase() and record()."""
+    perf = PerfRun(tool, package, db)
+    token = currentRun.set(perf)
+    ok = False
+    try:
+        yield perf
+        ok = True
+    finally:
+        currentRun.reset(token)
+        perf.save(ok)
+
+
+@contextmanager
+def phase(name):
+    perf = currentRun.get()
+    if perf is None:
+        yield
+        return
+    with perf.phase(name):
+        yield
+
+
+def record(**fields):
+    perf = currentRun.get()
+    if perf is not None:
+        perf.record(**fields)
+
+
+def wait(process, perf=None):
+    """
+    process.wait() of a subprocess.Popen, the max rss of the child is recorded
+    in `perf` (the current run by default).
+    """
+    perf = perf or currentRun.get()
+    if process.returncode is None:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # already reaped by a poll(), its memory is lost
+            return process.wait()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if perf is not None:
+            perf.record_child(usage.ru_maxrss)
+    return process.returncode
+
+
+def run_process(cmd, check=False, **kwargs):
+    """subprocess.run() for the JVMs of a run, without pipes, see wait()."""
+    with subprocess.Popen(cmd, **kwargs) as process:
+        try:
+            wait(process)
+        except BaseException:
+            process.kill()
+            raise
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return subprocess.CompletedProcess(process.args, process.returncode)
+
+
+def file_size(path):
+    return Path(path).stat().st_size if Path(path).exists() else None
+
+
+def find_regressions(conn, window, threshold, package=None):
+    """
+    Compare the last successful run of every tool/package with the median of
+    the `window` runs before it. A phase regressed if it took `threshold`
+    times its median; the output size is reported next to it to tell a
+    slower pipeline from a bigger app.
+    """
+    query = "SELECT id, tool, package, version_code, output_size, peak_memory_mb FROM runs WHERE ok = 1"
+    params = ()
+    if package:
+        query += " AND package = ?"
+        params = (package,)
+    runs = {}
+    for row in conn.execute(query + " ORDER BY started", params):
+        runs.setdefault((row[1], row[2]), []).append(row)
+
+    regressions = []
+    for (tool, pkg), history in sorted(runs.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+        if len(history) < 2:
+            continue
+        last, previous = history[-1], history[-1 - window : -1]
+        sizes = [r[4] for r in previous if r[4]]
+        size_ratio = last[4] / statistics.median(sizes) if last[4] and sizes else None
+
+        metrics = {}
+        for run_id, name, seconds in conn.execute(
+            "SELECT run_id, phase, seconds FROM phases WHERE run_id IN (%s)"
+            % ",".join("?" * (len(previous) + 1)),
+            [r[0] for r in previous] + [last[0]],
+        ):
+            metrics.setdefault(name, {})[run_id] = seconds
+        memory = {r[0]: r[5] for r in previous + [last] if r[5]}
+        metrics["peak memory (MB)"] = memory
+
+        for name, values in sorted(metrics.items()):
+            before = [values[r[0]] for r in previous if r[0] in values]
+            if last[0] not in values or not before:
+                continue
+            median = statistics.median(before)
+            if median > 0 and values[last[0]] > median * threshold:
+                regressions.append((tool, pkg, last[3], name, median, values[last[0]], size_ratio))
+    return regressions
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--db", default=PERF_HISTORY, show_default=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--package", default=None, help="only report this package")
+@click.option("--window", default=5, show_default=True, help="previous runs the median is computed on")
+@click.option("--threshold", default=1.25, show_default=True, help="a phase regressed if it is this many times its median")
+@click.option("--fail", is_flag=True, help="exit with an error if something regressed")
+def report(db, package, window, threshold, fail):
+    """Phases of the last run of every package that regressed against the rolling median."""
+    conn = connect(db)
+    regressions = find_regressions(conn, window, threshold, package)
+    conn.close()
+    if not regressions:
+        print("[=] no regressions")
+        return
+    print(f"{'tool':<10}{'package':<30}{'version':>10}  {'phase':<18}{'median':>10}{'last':>10}{'size':>8}")
+    for tool, pkg, version_code, name, median, last, size_ratio in regressions:
+        size = f"x{size_ratio:.2f}" if size_ratio else "-"
+        print(f"{tool:<10}{pkg or '-':<30}{version_code or '-':>10}  {name:<18}{median:>10.2f}{last:>10.2f}{size:>8}")
+    if fail:
+        raise click.ClickException(f"{len(regressions)} regressions")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+####################
+# Check the resources of a decoded APK before building it, so a broken merge fails in seconds instead of in aapt.
+# -> every defined resource: values files, res/<type>/ files, @+id and public.xml
+# -> every reference in res/**/*.xml and AndroidManifest.xml must resolve to one of them
+# -> public.xml ids must be unique, one id per resource and one type id per type
+# An unresolved reference is only a warning unless strict: text that looks like one (a string
+# "@someone/status") or a resource of a library apktool did not decode is not always an error for aapt.
+####################
+import argparse
+import os
+import re
+import sys
+from dataclasses import dataclass
+
+import xml_backend
+
+# @[+][*][package:]type/name
+REFERENCE_RE = re.compile(r"^@(\+)?\*?(?:([\w.]+):)?([\w-]+)/(.+)$")
+# ?[package:][type/]name
+ATTRIBUTE_RE = re.compile(r"^\?\*?(?:([\w.]+):)?(?:(attr)/)?([\w.]+)$")
+
+# types a reference can have, "@someone/status" in a string is text
+RESOURCE_TYPES = {
+    "anim", "animator", "array", "attr", "bool", "color", "dimen", "drawable", "font", "fraction", "id",
+    "integer", "interpolator", "layout", "menu", "mipmap", "navigation", "plurals", "raw", "string",
+    "style", "styleable", "transition", "xml",
+}
+# problems the build goes on with unless strict
+WARNINGS = {"dangling reference", "dummy reference"}
+
+# values tags defining a resource of another type
+VALUES_TYPES = {
+    "string-array": "array",
+    "integer-array": "array",
+    "declare-styleable": "styleable",
+}
+# values tags that do not define resources
+NOT_RESOURCES = {"public", "eat-comment", "skip", "java-symbol", "add-resource", "overlayable"}
+
+
+@dataclass
+class Problem:
+    kind: str
+    path: str
+    message: str
+
+    def __str__(self):
+        return f"{self.kind}: {self.message} ({self.path})"
+
+
+class ResourceIndex:
+    def __init__(self, package):
+        self.package = package
+        self.defined = set()
+        self.references = []
+
+    def define(self, resType, name):
+        self.defined.add((resType, name))
+
+    def refer(self, resType, name, path):
+        self.references.append((resType, name, path))
+
+    def isLocal(self, package):
+        return package is None or package == self.package
+
+    def scanValue(self, value, path):
+        """Index a reference in an attribute or text, definitions for @+id."""
+        value = value.strip()
+        if value.startswith("@"):
+            m = REFERENCE_RE.match(value)
+            if m is None or not self.isLocal(m.group(2)) or m.group(3) not in RESOURCE_TYPES:
+                return
+            if m.group(1):
+                self.define(m.group(3), m.group(4))
+            else:
+                self.refer(m.group(3), m.group(4), path)
+        elif value.startswith("?"):
+            m = ATTRIBUTE_RE.match(value)
+            if m is not None and self.isLocal(m.group(1)):
+                self.refer("attr", m.group(3), path)
+
+
+def resourceType(resDir):
+    return resDir.split("-")[0]
+
+
+def indexValues(index, doc, path):
+    for el in xml_backend.childElements(doc.root):
+        if el.tag in NOT_RESOURCES or "name" not in el.attrib:
+            continue
+        name = el.attrib["name"]
+        if el.tag == "item":
+            resType = el.attrib.get("type")
+            if resType is None:
+                continue
+        else:
+            resType = VALUES_TYPES.get(el.tag, el.tag)
+        index.define(resType, name)
+
+        if el.tag == "declare-styleable":
+            for attr in xml_backend.childElements(el):
+                if attr.tag == "attr" and "name" in attr.attrib and ":" not in attr.attrib["name"]:
+                    index.define("attr", attr.attrib["name"])
+        elif el.tag == "style":
+            parent = el.attrib.get("parent")
+            if parent and not parent.startswith("@") and ":" not in parent:
+                index.refer("style", parent, path)
+            for item in xml_backend.childElements(el):
+                attrName = item.attrib.get("name", "")
+                if attrName and ":" not in attrName:
+                    index.refer("attr", attrName, path)
+
+
+def indexDocument(index, doc, path):
+    for el in doc.elements():
+        for value in el.attrib.values():
+            index.scanValue(value, path)
+        if el.text:
+            index.scanValue(el.text, path)
+
+
+def checkPublicXml(publicXml):
+    problems = []
+    byId = {}
+    byName = {}
+    typeIds = {}
+    typeNames = {}
+    for el in xml_backend.iterElements(publicXml, "public"):
+        resType, name, resId = el.attrib.get("type"), el.attrib.get("name"), el.attrib.get("id")
+        if None in (resType, name, resId):
+            continue
+        key = (resType, name)
+        if resId in byId and byId[resId] != key:
+            problems.append(Problem("duplicate id", publicXml, f"{resId} is {byId[resId][0]}/{byId[resId][1]} and {resType}/{name}"))
+        if key in byName and byName[key] != resId:
+            problems.append(Problem("duplicate name", publicXml, f"{resType}/{name} has ids {byName[key]} and {resId}"))
+        typeId = int(resId, 16) >> 16 & 0xFF
+        if typeIds.setdefault(resType, typeId) != typeId:
+            problems.append(Problem("type id conflict", publicXml, f"{resType}/{name} {resId} is not in type 0x{typeIds[resType]:02x}"))
+        elif typeNames.setdefault(typeId, resType) != resType:
+            problems.append(Problem("type id conflict", publicXml, f"{resType}/{name} {resId} is in the type of {typeNames[typeId]}"))
+        byId.setdefault(resId, key)
+        byName.setdefault(key, resId)
+    return problems, set(byName)
+
+
+####################
+# The problems that must stop the build, the references too if strict
+####################
+def errors(problems, strict=False):
+    return [problem for problem in problems if strict or problem.kind not in WARNINGS]
+
+
+def validateResources(apkdir):
+    """Every problem found in the resources of a decoded APK, empty if it should build."""
+    problems = []
+    manifest = xml_backend.parse(os.path.join(apkdir, "AndroidManifest.xml"))
+    index = ResourceIndex(manifest.root.attrib.get("package"))
+    indexDocument(index, manifest, os.path.join(apkdir, "AndroidManifest.xml"))
+
+    resRoot = os.path.join(apkdir, "res")
+    for resDir in sorted(os.listdir(resRoot)) if os.path.isdir(resRoot) else []:
+        resType = resourceType(resDir)
+        for f in sorted(os.listdir(os.path.join(resRoot, resDir))):
+            path = os.path.join(resRoot, resDir, f)
+            if resType != "values":
+                # res/drawable-hdpi/icon.9.png -> drawable/icon
+                index.define(resType, f.split(".")[0])
+            if not f.endswith(".xml"):
+                continue
+            try:
+                doc = xml_backend.parse(path)
+            except xml_backend.ParseError as e:
+                problems.append(Problem("parse error", path, str(e)))
+                continue
+            if resType == "values":
+                if f == "public.xml":
+                    continue
+                indexValues(index, doc, path)
+            indexDocument(index, doc, path)
+
+    declared = set()
+    publicXml = os.path.join(resRoot, "values", "public.xml")
+    if os.path.exists(publicXml):
+        publicProblems, declared = checkPublicXml(publicXml)
+        problems += publicProblems
+        for resType, name in sorted(declared - index.defined):
+            problems.append(Problem("undefined public", publicXml, f"{resType}/{name} is declared but never defined"))
+
+    for resType, name, path in index.references:
+        if (resType, name) not in index.defined:
+            kind = "dummy reference" if "APKTOOL_DUMMY" in name else "dangling reference"
+            problems.append(Problem(kind, path, f"@{resType}/{name}"))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the resource references of a decoded APK.")
+    parser.add_argument("apkdir", help="folder decoded by apktool")
+    parser.add_argument("--strict", action="store_true", help="unresolved references are errors too")
+    args = parser.parse_args()
+    problems = validateResources(args.apkdir)
+    for problem in problems:
+        print(problem)
+    failing = errors(problems, args.strict)
+    print(f"{len(problems)} problems, {len(failing)} errors")
+    sys.exit(1 if failing else 0)
+
+
+if __name__ == "__main__":
+    main()
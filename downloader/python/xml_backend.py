@@ -0,0 +1,94 @@
+####################
+# XML backend of the merge passes: lxml when it is installed, xml.etree.ElementTree otherwise.
+# -> every document keeps its own namespace map, nothing is registered globally with lxml
+# -> read-only scans (public.xml) are streamed and cleared element by element
+# -> documents are written once, straight to the file, and only when they changed
+####################
+import threading
+
+try:
+    from lxml import etree
+
+    BACKEND = "lxml"
+    ParseError = etree.XMLSyntaxError
+except ImportError:
+    import xml.etree.ElementTree as etree
+
+    BACKEND = "etree"
+    ParseError = etree.ParseError
+
+# ElementTree picks the prefixes it writes from a global registry
+_registerLock = threading.Lock()
+
+
+def _parser():
+    # resources.arsc of big apps decode to values/*.xml of several MB
+    return etree.XMLParser(huge_tree=True, remove_blank_text=False)
+
+
+class XmlDocument:
+    def __init__(self, path, tree, nsmap):
+        self.path = path
+        self.tree = tree
+        self.root = tree.getroot()
+        self.nsmap = nsmap
+
+    def ns(self, prefix):
+        """"{uri}" of a prefix of this document, to build attribute names."""
+        return "{" + self.nsmap[prefix] + "}"
+
+    def elements(self):
+        """Every element of the document (not comments or processing instructions)."""
+        if BACKEND == "lxml":
+            return self.root.iter(etree.Element)
+        return self.root.iter()
+
+    def write(self, path=None):
+        path = str(path or self.path)
+        if BACKEND == "lxml":
+            self.tree.write(path, encoding="utf-8", xml_declaration=True)
+            return
+        with _registerLock:
+            for prefix, uri in self.nsmap.items():
+                etree.register_namespace(prefix, uri)
+            self.tree.write(path, encoding="utf-8", xml_declaration=True)
+
+
+def parse(path):
+    """Parse a file, collecting its namespace map in the same pass."""
+    path = str(path)
+    if BACKEND == "lxml":
+        tree = etree.parse(path, _parser())
+        # lxml keeps the prefixes of every element when writing, the map is only for ns()
+        nsmap = {prefix or "": uri for prefix, uri in tree.getroot().nsmap.items()}
+        return XmlDocument(path, tree, nsmap)
+
+    nsmap = {}
+    events = etree.iterparse(path, events=("start-ns",))
+    for _, (prefix, uri) in events:
+        nsmap.setdefault(prefix, uri)
+    return XmlDocument(path, etree.ElementTree(events.root), nsmap)
+
+
+def childElements(el):
+    if BACKEND == "lxml":
+        return el.iterchildren(etree.Element)
+    return iter(el)
+
+
+def iterElements(path, tag):
+    """Stream the `tag` elements of a file, each one is cleared once the caller has seen it."""
+    path = str(path)
+    if BACKEND == "lxml":
+        for _, el in etree.iterparse(path, events=("end",), tag=tag, huge_tree=True):
+            yield el
+            el.clear()
+        return
+    for _, el in etree.iterparse(path, events=("end",)):
+        if el.tag == tag:
+            yield el
+            el.clear()
+
+
+def makeElement(parent, tag, attrib):
+    return parent.makeelement(tag, attrib)
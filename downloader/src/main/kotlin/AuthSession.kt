@@ -0,0 +1,123 @@
+import com.aurora.gplayapi.data.models.AuthData
+import com.aurora.gplayapi.helpers.AuthHelper
+import com.google.gson.GsonBuilder
+import com.google.gson.JsonDeserializer
+import com.google.gson.JsonObject
+import com.google.gson.JsonParser
+import com.google.gson.JsonPrimitive
+import com.google.gson.JsonSerializer
+import java.nio.file.Files
+import java.nio.file.Path
+import java.nio.file.Paths
+import java.nio.file.StandardCopyOption
+import java.security.MessageDigest
+import java.security.SecureRandom
+import java.util.*
+import javax.crypto.Cipher
+import javax.crypto.SecretKeyFactory
+import javax.crypto.spec.GCMParameterSpec
+import javax.crypto.spec.PBEKeySpec
+import javax.crypto.spec.SecretKeySpec
+
+// AUTH_CACHE_DIR="" disables the cache
+val AUTH_CACHE_DIR: String = System.getenv("AUTH_CACHE_DIR")
+    ?: Paths.get(System.getProperty("user.home"), ".cache", "apk-downloader").toString()
+val AUTH_CACHE_TTL_MS = (System.getenv("AUTH_CACHE_TTL_HOURS")?.toLongOrNull() ?: 6L) * 3600 * 1000
+
+const val SALT_BYTES = 16
+const val IV_BYTES = 12
+const val KEY_ITERATIONS = 65536
+
+// gplayapi has no exception type for a rejected login, its errors carry the http status or reason in their message
+val AUTH_FAILURE = Regex("""\b(401|403)\b|unauthori[sz]ed|forbidden|authentication""", RegexOption.IGNORE_CASE)
+
+fun isAuthFailure(e: Throwable): Boolean =
+    generateSequence(e) { it.cause }.any { AUTH_FAILURE.containsMatchIn(it.message ?: "") }
+
+// the store login (AuthHelper.build) of a mail and device profile, kept encrypted in AUTH_CACHE_DIR with
+// a key derived from the aasToken, so the runs of the night reuse it instead of logging in again every time
+class AuthSession(private val user: String, private val token: String, profile: String, private val props: Properties) {
+
+    private val file: Path? = if (AUTH_CACHE_DIR.isEmpty()) null
+        else Paths.get(AUTH_CACHE_DIR, "auth-${sha256("$user\n$profile").take(16)}.bin")
+    private var auth: AuthData? = null
+    private var refreshed = false
+
+    private val gson = GsonBuilder()
+        // java.util.Locale is not a plain bean, keep it as a language tag
+        .registerTypeAdapter(Locale::class.java, JsonSerializer<Locale> { src, _, _ -> JsonPrimitive(src.toLanguageTag()) })
+        .registerTypeAdapter(Locale::class.java, JsonDeserializer<Locale> { json, _, _ -> Locale.forLanguageTag(json.asString) })
+        .create()
+
+    // runs the requests of `block`, the store rejecting the cached login logs in again (once per run) and retries,
+    // any other failure (unknown package, purchase error...) is thrown as is
+    fun <T> use(block: (AuthData) -> T): T {
+        val current = auth ?: load() ?: login()
+        return try {
+            block(current)
+        } catch (e: Exception) {
+            if (refreshed || !isAuthFailure(e)) throw e
+            println("the store rejected the cached login (${e.message}), logging in again")
+            block(login())
+        }
+    }
+
+    private fun login(): AuthData {
+        val fresh = AuthHelper.build(user, token, props)
+        auth = fresh
+        refreshed = true
+        save(fresh)
+        return fresh
+    }
+
+    private fun load(): AuthData? {
+        if (file == null || !Files.exists(file)) return null
+        return try {
+            val bytes = Files.readAllBytes(file)
+            val salt = bytes.copyOfRange(0, SALT_BYTES)
+            val iv = bytes.copyOfRange(SALT_BYTES, SALT_BYTES + IV_BYTES)
+            val cipher = Cipher.getInstance("AES/GCM/NoPadding")
+            cipher.init(Cipher.DECRYPT_MODE, key(salt), GCMParameterSpec(128, iv))
+            val content = JsonParser.parseString(String(cipher.doFinal(bytes, SALT_BYTES + IV_BYTES, bytes.size - SALT_BYTES - IV_BYTES))).asJsonObject
+            if (System.currentTimeMillis() - content["created"].asLong > AUTH_CACHE_TTL_MS) {
+                return null
+            }
+            gson.fromJson(content["auth"], AuthData::class.java).also { auth = it }
+        } catch (e: Exception) {
+            // another aasToken (the key does not match) or a damaged file, log in again
+            println("ignoring the cached login: ${e.message ?: e.javaClass.simpleName}")
+            null
+        }
+    }
+
+    private fun save(data: AuthData) {
+        if (file == null) return
+        try {
+            val content = JsonObject()
+            content.addProperty("created", System.currentTimeMillis())
+            content.add("auth", gson.toJsonTree(data))
+
+            val salt = ByteArray(SALT_BYTES).also { SecureRandom().nextBytes(it) }
+            val iv = ByteArray(IV_BYTES).also { SecureRandom().nextBytes(it) }
+            val cipher = Cipher.getInstance("AES/GCM/NoPadding")
+            cipher.init(Cipher.ENCRYPT_MODE, key(salt), GCMParameterSpec(128, iv))
+
+            // downloaders of parallel jobs share the file, every one writes its own temporary file
+            Files.createDirectories(file.parent)
+            val tmp = Files.createTempFile(file.parent, file.fileName.toString(), ".tmp")
+            Files.write(tmp, salt + iv + cipher.doFinal(content.toString().toByteArray()))
+            Files.move(tmp, file, StandardCopyOption.ATOMIC_MOVE, StandardCopyOption.REPLACE_EXISTING)
+        } catch (e: Exception) {
+            // the cache is never a reason to fail a download
+            println("could not cache the login: ${e.message ?: e.javaClass.simpleName}")
+        }
+    }
+
+    private fun key(salt: ByteArray): SecretKeySpec {
+        val spec = PBEKeySpec(token.toCharArray(), salt, KEY_ITERATIONS, 256)
+        return SecretKeySpec(SecretKeyFactory.getInstance("PBKDF2WithHmacSHA256").generateSecret(spec).encoded, "AES")
+    }
+}
+
+fun sha256(text: String): String =
+    MessageDigest.getInstance("SHA-256").digest(text.toByteArray()).joinToString("") { "%02x".format(it) }
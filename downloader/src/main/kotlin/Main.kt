@@ -1,50 +1,134 @@
 import com.aurora.gplayapi.helpers.AppDetailsHelper
-import com.aurora.gplayapi.helpers.AuthHelper
 import com.aurora.gplayapi.helpers.PurchaseHelper
 import java.io.InputStream
 import java.net.URL
 import java.nio.file.Files
+import java.nio.file.Path
 import java.nio.file.Paths
 import java.nio.file.StandardCopyOption
 import java.util.*
 import kotlin.system.exitProcess
 
 
-fun main(args: Array<String>) {
+// profiles in src/main/resources/profiles, each one only overrides some properties of my-device.properties
+val PROFILES = listOf("my-device", "arm64-xxhdpi-en", "arm64-xhdpi-en", "armv7-hdpi-en")
+const val DEFAULT_PROFILE = "my-device"
 
-    if (args.count() != 3) {
+fun loadProfile(name: String): Properties {
+    val resources = {}.javaClass
+    val props = Properties()
+    resources.getResource("my-device.properties").openStream().use { props.load(it) }
+    if (name != DEFAULT_PROFILE) {
+        val overlay = resources.getResource("profiles/$name.properties")
+        if (overlay == null) {
+            println("unknown device profile $name, available: ${PROFILES.joinToString()}")
+            exitProcess(1)
+        }
+        overlay.openStream().use { props.load(it) }
+    }
+    return props
+}
+
+fun main(argv: Array<String>) {
+
+    var profile = DEFAULT_PROFILE
+    var listSplits = false
+    var versions = false
+    val args = mutableListOf<String>()
+    var i = 0
+    while (i < argv.size) {
+        when (argv[i]) {
+            "--device-profile" -> profile = argv.getOrElse(++i) { "" }
+            "--list-splits" -> listSplits = true
+            "--versions" -> versions = true
+            "--list-profiles" -> {
+                PROFILES.forEach { println(it) }
+                exitProcess(0)
+            }
+            else -> args.add(argv[i])
+        }
+        i++
+    }
+
+    if (versions && args.count() >= 3) {
+        printVersions(AuthSession(args[0], args[1], profile, loadProfile(profile)), args.drop(2))
+        return
+    }
+
+    if (args.count() !in 3..4) {
         println("not enough arguments:")
         println("first argument is the mail for authentication")
         println("second argument is the aasToken")
         println("third argument is the packageName")
+        println("fourth (optional) argument is the output folder, defaults to output")
+        println("--device-profile <name> device the store sees, one of ${PROFILES.joinToString()}")
+        println("--list-splits only print the files the profile gets, without downloading them")
+        println("--versions <mail> <aasToken> <packageName>... only print the versionCode of every package")
         exitProcess(1)
     }
 
-    val stream =   {}.javaClass.getResource("my-device.properties").openStream()
-
-    val props = Properties()
-    props.load(stream)
+    val props = loadProfile(profile)
 
 
     var user = args[0];
     var token = args[1];
     var packageName = args[2];
+    var outputDir = args.getOrElse(3) { "output" };
+
+    val session = AuthSession(user, token, profile, props)
+    val files = session.use { auth ->
+        val app = AppDetailsHelper(auth).getAppByPackageName(packageName)
 
-    val auth = AuthHelper.build(user, token, props)
-    val app = AppDetailsHelper(auth).getAppByPackageName(packageName)
+        PurchaseHelper(auth).purchase(
+            app.packageName,
+            app.versionCode,
+            app.offerType
+        )
+    }
 
+    if (listSplits) {
+        // read by python/device_profiles.py
+        files.forEach { println("split\t${it.name}\t${it.size}") }
+        return
+    }
 
-    val files = PurchaseHelper(auth).purchase(
-        app.packageName,
-        app.versionCode,
-        app.offerType
-    )
+    Files.createDirectories(Paths.get(outputDir))
+    // files of an older download with the same names would look complete
+    Files.deleteIfExists(Paths.get(outputDir, READY))
+    files.forEach { Files.deleteIfExists(Paths.get(outputDir, it.name)) }
+    publish(Paths.get(outputDir, MANIFEST), files.joinToString("\n") { it.name }.toByteArray())
 
     files.forEach {
         println("${it.name} ${it.url}")
 
+        // the merge starts decoding every file as soon as it has its final name
+        val part = Paths.get(outputDir, it.name + ".part")
         val `in`: InputStream = URL(it.url).openStream()
-        Files.copy(`in`, Paths.get("output/${it.name}"), StandardCopyOption.REPLACE_EXISTING)
+        `in`.use { stream -> Files.copy(stream, part, StandardCopyOption.REPLACE_EXISTING) }
+        Files.move(part, Paths.get(outputDir, it.name), StandardCopyOption.ATOMIC_MOVE, StandardCopyOption.REPLACE_EXISTING)
     }
 
+    publish(Paths.get(outputDir, READY), ByteArray(0))
+}
+
+// read by pipeline/watch.py, a single login for every package
+fun printVersions(session: AuthSession, packageNames: List<String>) {
+    packageNames.forEach {
+        try {
+            val versionCode = session.use { auth -> AppDetailsHelper(auth).getAppByPackageName(it).versionCode }
+            println("version\t$it\t$versionCode")
+        } catch (e: Exception) {
+            println("missing\t$it\t${(e.message ?: e.javaClass.simpleName).lines().first()}")
+        }
+    }
+}
+
+// markers read by python/download_progress.py
+const val MANIFEST = "download.manifest"
+const val READY = "download.ready"
+
+fun publish(path: Path, content: ByteArray) {
+    val tmp = path.resolveSibling(path.fileName.toString() + ".tmp")
+    Files.write(tmp, content)
+    Files.move(tmp, path, StandardCopyOption.ATOMIC_MOVE, StandardCopyOption.REPLACE_EXISTING)
 }
\ No newline at end of file
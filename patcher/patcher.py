@@ -1,18 +1,144 @@
 import click
+import contextlib
+import functools
+import hashlib
+import os
+import shutil
 import tempfile
 import subprocess
 import xml.etree.ElementTree
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-APK_TOOL_BASE = ["java", "-jar", "apktool_2.5.0.jar"]
+# shared with merge_apk.py and entrypoint.py, in downloader/python (copied next to patcher.py by the Dockerfile)
+from apk_output import normalize_apk, read_apktool_yml, write_metadata
+from jvm import shared_archive
 
+try:
+    # performance history, metrics and aapt2 cache of downloader/python, there
+    # when they are on the path (pipeline image)
+    import aapt2_cache
+    import metrics
+    import perf_history
+except ImportError:
+    aapt2_cache = metrics = perf_history = None
 
-def decompile(apk, workfolder):
-    subprocess.run(APK_TOOL_BASE + ["d", "-f", "-o", workfolder, apk], check=True)
+APK_TOOL_JAR = os.environ.get("APKTOOL_JAR", "apktool_2.5.0.jar")
+# smali assembler, a smali jar or an apktool jar that still has its command line
+SMALI_JAR = os.environ.get("SMALI_JAR", APK_TOOL_JAR)
+SMALI_MAIN = "org.jf.smali.Main"
+SMALI_MIN_HEAP_MB = 256
 
 
-def rebuild(workfolder, output):
-    subprocess.run(APK_TOOL_BASE + ["b", "-o", output, workfolder], check=True)
+def java(heap_mb=None):
+    # absolute path, the archive is only used with the classpath it was made for
+    jar = str(Path(APK_TOOL_JAR).resolve())
+    heap = [f"-Xmx{heap_mb}m"] if heap_mb else []
+    return ["java"] + heap + shared_archive(jar), jar
+
+
+def apktool(heap_mb=None):
+    cmd, jar = java(heap_mb)
+    return cmd + ["-jar", jar]
+
+
+@functools.lru_cache(maxsize=None)
+def check_smali_jar(jar):
+    # the released apktool jars are shrunk, their smali library may not keep the command line
+    entry = SMALI_MAIN.replace(".", "/") + ".class"
+    with zipfile.ZipFile(jar) as zf:
+        if entry not in zf.namelist():
+            raise click.ClickException(f"{jar} has no {SMALI_MAIN}, set SMALI_JAR to a smali jar")
+
+
+def smali(heap_mb=None):
+    jar = str(Path(SMALI_JAR).resolve())
+    check_smali_jar(jar)
+    heap = [f"-Xmx{heap_mb}m"] if heap_mb else []
+    return ["java"] + heap + shared_archive(jar) + ["-cp", jar, SMALI_MAIN]
+
+
+def run_jvm(cmd, check=False):
+    with metrics.jvm() if metrics else contextlib.nullcontext():
+        if perf_history:
+            # records the memory of the jvm in the run
+            return perf_history.run_process(cmd, check=check)
+        return subprocess.run(cmd, check=check)
+
+
+def decompile(apk, workfolder, heap_mb=None):
+    run_jvm(apktool(heap_mb) + ["d", "-f", "-o", workfolder, apk], check=True)
+
+
+def rebuild(workfolder, output, heap_mb=None):
+    # with aapt2 and cached compiled resources when available, see aapt2_cache.py
+    aapt2 = aapt2_cache.apktoolArgs() if aapt2_cache else []
+    run_jvm(apktool(heap_mb) + ["b"] + aapt2 + ["-o", output, workfolder], check=True)
+
+
+def dex_name(smali_dir):
+    # smali -> classes.dex, smali_classes2 -> classes2.dex
+    return "classes.dex" if smali_dir == "smali" else smali_dir[len("smali_"):] + ".dex"
+
+
+def snapshot_smali(workfolder):
+    """
+    Fingerprint of every smali folder of a decoded apk (path, size and
+    mtime of its files), to know later which ones a patch touched.
+    """
+    snapshot = {}
+    for smali_dir in sorted(Path(workfolder).glob("smali*")):
+        if not smali_dir.is_dir():
+            continue
+        h = hashlib.sha256()
+        for f in sorted(smali_dir.rglob("*")):
+            if f.is_file():
+                stat = f.stat()
+                h.update(f"{f.relative_to(smali_dir)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        snapshot[smali_dir.name] = h.hexdigest()
+    return snapshot
+
+
+def assemble(workfolder, smali_dir, api, heap_mb=None):
+    dex = workfolder / dex_name(smali_dir)
+    cmd = smali(heap_mb) + ["a", "-o", str(dex)] + (["--api", api] if api else []) + [str(workfolder / smali_dir)]
+    run_jvm(cmd, check=True)
+    shutil.rmtree(workfolder / smali_dir)
+
+
+def reuse_unchanged_dex(apk, workfolder, snapshot, heap_mb=None):
+    """
+    Put back the original classesN.dex of the apk for every smali folder that
+    did not change since `snapshot` and assemble the changed ones in
+    parallel, apktool b then only copies the dex files it finds.
+    """
+    # fails before the smali folders are replaced, not halfway
+    check_smali_jar(str(Path(SMALI_JAR).resolve()))
+    workfolder = Path(workfolder)
+    current = snapshot_smali(workfolder)
+    changed = [d for d in current if current[d] != snapshot.get(d)]
+
+    with zipfile.ZipFile(apk) as zf:
+        names = set(zf.namelist())
+        for smali_dir in current:
+            if smali_dir in changed:
+                continue
+            if dex_name(smali_dir) not in names:
+                changed.append(smali_dir)
+                continue
+            (workfolder / dex_name(smali_dir)).write_bytes(zf.read(dex_name(smali_dir)))
+            shutil.rmtree(workfolder / smali_dir)
+    print(f"[*] reusing {len(current) - len(changed)} dex files, assembling {len(changed)}")
+
+    if changed:
+        api = read_apktool_yml(workfolder, "minSdkVersion")
+        workers = min(len(changed), os.cpu_count() or 1)
+        # the heap given to the job is shared by the assemblers
+        heap = max(SMALI_MIN_HEAP_MB, heap_mb // workers) if heap_mb else None
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda d: assemble(workfolder, d, api, heap), changed))
+    return changed
 
 
 def get_pkg_name(workfolder):
@@ -79,20 +205,64 @@ def patch_twitter(workfolder):
         f.write(data)
 
 
-@click.command()
-@click.argument("input", type=click.Path(exists=True))
-@click.argument("output", type=click.Path(exists=False, dir_okay=False))
-def patch(input, output):
-    with tempfile.TemporaryDirectory() as tmpdirname:
+PATCHES = {
+    "com.twitter.android": patch_twitter,
+}
+
+
+def perf_run(tool):
+    return perf_history.run(tool) if perf_history else contextlib.nullcontext()
+
+
+def metrics_stage(name):
+    return metrics.stage(name) if metrics else contextlib.nullcontext()
+
+
+def perf_phase(name):
+    return perf_history.phase(name) if perf_history else contextlib.nullcontext()
+
+
+def perf_record(**fields):
+    if perf_history:
+        perf_history.record(**fields)
+
+
+def patch_apk(input, output, metadata=False, deterministic=False, heap_mb=None):
+    with metrics_stage("patch"), perf_run("patch"), tempfile.TemporaryDirectory() as tmpdirname:
         # tmpdirname = "/tmp/workfolder"
         print(f"temp dir is {tmpdirname}")
-        decompile(input, tmpdirname)
+        with perf_phase("decode"):
+            decompile(input, tmpdirname, heap_mb)
         package = get_pkg_name(tmpdirname)
+        version_code = read_apktool_yml(tmpdirname, "versionCode")
+        perf_record(package=package, version_code=int(version_code) if version_code else None)
+
+        if package in PATCHES:
+            snapshot = snapshot_smali(tmpdirname)
+            with perf_phase("patch"):
+                PATCHES[package](tmpdirname)
+            with perf_phase("assemble"):
+                reuse_unchanged_dex(input, tmpdirname, snapshot, heap_mb)
 
-        if package == "com.twitter.android":
-            patch_twitter(tmpdirname)
+        with perf_phase("build"):
+            rebuild(tmpdirname, output, heap_mb)
+        if deterministic:
+            with perf_phase("normalize"):
+                normalize_apk(output)
 
-        rebuild(tmpdirname, output)
+        if metadata:
+            with perf_phase("metadata"):
+                write_metadata(tmpdirname, output)
+        perf_record(output_size=Path(output).stat().st_size)
+
+
+@click.command()
+@click.argument("input", type=click.Path(exists=True))
+@click.argument("output", type=click.Path(exists=False, dir_okay=False))
+@click.option("--write-metadata", "metadata", is_flag=True, help="write <output>.json and <output>.png with the package metadata and icon")
+@click.option("--deterministic", is_flag=True, help="sorted zip entries and fixed timestamps, same input gives the same apk")
+def patch(input, output, metadata, deterministic):
+    patch_apk(input, output, metadata, deterministic)
 
 
 if __name__ == "__main__":
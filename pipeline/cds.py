@@ -0,0 +1,154 @@
+import click
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "downloader" / "python"))
+sys.path.insert(0, str(ROOT / "patcher"))
+
+import entrypoint
+import jvm
+import patcher
+import signing
+
+ANDROID_HOME = os.environ.get("ANDROID_HOME", "/opt/android-sdk")
+# android.jar has the compiled framework resources, apktool can decode and
+# build it like an apk, so it is used as the training apk
+TRAINING_APK = Path(ANDROID_HOME) / "platforms" / "android-30" / "android.jar"
+MERGE_APKTOOL_JAR = ROOT / "downloader" / "python" / "apktool-cli-all.jar"
+
+
+def jars():
+    return {
+        "apktool (merge)": MERGE_APKTOOL_JAR,
+        "apktool (patcher)": Path(patcher.APK_TOOL_JAR),
+        "signer": Path(signing.SIGNER_JAR),
+        "downloader": Path(entrypoint.DOWNLOADER_JAR),
+    }
+
+
+def training_runs(name, apk, tmp):
+    """
+    Commands run to record the classes a jar loads. They do not need to
+    succeed, the classes loaded until the failure are archived anyway. The
+    downloader is only run offline, a training run must not log in to the
+    store while the image is built.
+    """
+    if name.startswith("apktool"):
+        decoded = tmp / "decoded"
+        return [
+            ["d", "-f", "-s", "-o", str(decoded), str(apk)],
+            ["b", "-o", str(tmp / "training.apk"), str(decoded)],
+        ]
+    if name == "signer":
+        return [["--allowResign", "--overwrite", "-a", str(tmp / "training.apk")]]
+    return [["--list-profiles"]]
+
+
+def startup_run(name):
+    """Command that exits right after starting, to measure the startup time"""
+    if name.startswith("apktool"):
+        return ["-version"]
+    if name == "signer":
+        return ["--help"]
+    # no arguments, fails as soon as main() starts
+    return []
+
+
+def dump(name, jar, apk, tmp):
+    jar = str(jar.resolve())
+    archive = Path(jar).with_suffix(".jsa")
+    classlist = tmp / f"{Path(jar).stem}.classlist"
+    if archive.exists():
+        archive.unlink()
+
+    print(f"[*] recording the classes loaded by {name}")
+    for args in training_runs(name, apk, tmp):
+        CMD = ["java", f"-XX:DumpLoadedClassList={classlist}", "-jar", jar] + args
+        try:
+            subprocess.run(CMD, stdout=subprocess.DEVNULL, timeout=600)
+        except subprocess.TimeoutExpired:
+            print(f"[-] {' '.join(args[:1])} timed out, archiving what was loaded")
+        # every run overwrites the list, keep them all
+        with open(tmp / "all.classlist", "a") as all_classes:
+            all_classes.write(classlist.read_text() if classlist.exists() else "")
+
+    print(f"[*] dumping {archive}")
+    subprocess.run(
+        [
+            "java",
+            "-Xshare:dump",
+            f"-XX:SharedClassListFile={tmp / 'all.classlist'}",
+            f"-XX:SharedArchiveFile={archive}",
+            "-cp",
+            jar,
+        ],
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    (tmp / "all.classlist").unlink()
+    return archive
+
+
+def time_runs(CMD, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(CMD, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def java_version():
+    # java -version prints to stderr
+    return subprocess.run(["java", "-version"], capture_output=True, text=True).stderr.splitlines()[0]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(name="dump")
+@click.option("--apk", default=str(TRAINING_APK), type=click.Path(exists=True, dir_okay=False), help="apk decoded, built and signed to train the archives")
+def dump_archives(apk):
+    """Make a class-data-sharing archive (<jar>.jsa) for every jar found."""
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, jar in jars().items():
+            if not jar.exists():
+                print(f"[-] {jar} not found, skipping {name}")
+                continue
+            dump(name, jar, apk, Path(tmp))
+
+
+@cli.command()
+@click.option("--runs", default=10, show_default=True, help="runs of every jar, with and without its archive")
+@click.option("--record", default=None, type=click.Path(dir_okay=False), help="also write the medians to this file, as a markdown table")
+def bench(runs, record):
+    """Startup time (median) of every jar without and with its archive."""
+    print(f"{'jar':<20}{'without':>12}{'with':>12}{'speedup':>10}")
+    rows = []
+    for name, jar in jars().items():
+        if not jar.exists() or not jvm.shared_archive(jar.resolve()):
+            print(f"{name:<20}{'no jar or archive':>34}")
+            continue
+        args = startup_run(name)
+        without = statistics.median(time_runs(["java", "-jar", str(jar.resolve())] + args, runs))
+        # same flags as the pipeline
+        shared = statistics.median(time_runs(entrypoint.java(jar) + args, runs))
+        print(f"{name:<20}{without * 1000:>10.0f}ms{shared * 1000:>10.0f}ms{without / shared:>9.2f}x")
+        rows.append(f"| {name} | {without * 1000:.0f} ms | {shared * 1000:.0f} ms | {without / shared:.2f}x |")
+    if record:
+        with open(record, "w") as fh:
+            fh.write(f"Median startup of {runs} runs, {time.strftime('%Y-%m-%d')}, `java -version`: {java_version()}\n\n")
+            fh.write("| jar | without archive | with archive | speedup |\n|---|---|---|---|\n")
+            fh.write("".join(row + "\n" for row in rows))
+
+
+if __name__ == "__main__":
+    cli()
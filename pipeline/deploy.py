@@ -0,0 +1,117 @@
+import click
+import json
+import os
+import shutil
+from pathlib import Path
+
+import repo_index
+from digest import file_digest
+
+DEPLOYED_DIRS = ["repo", "archive"]
+MANIFEST = ".manifest.json"
+
+
+def is_index(path):
+    # index-v1.jar, index-v1.json, index.xml, entry.jar... clients read these
+    # first, so they are swapped in once every file they point to is there
+    name = Path(path).name
+    return name.startswith("index") or name.startswith("entry")
+
+
+def load_json(path, default):
+    path = Path(path)
+    if not path.exists():
+        return default
+    with path.open() as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open(mode="w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def build_manifest(fdroid_dir):
+    """
+    {relative path: sha256} of every deployed file. Hashes are cached in
+    tmp/deploy-cache.json by size and mtime so only new or modified files
+    are read.
+    """
+    fdroid_dir = Path(fdroid_dir)
+    cache_file = fdroid_dir / "tmp" / "deploy-cache.json"
+    cache = load_json(cache_file, {})
+
+    manifest = {}
+    new_cache = {}
+    for d in DEPLOYED_DIRS:
+        for path in sorted((fdroid_dir / d).rglob("*")):
+            if not path.is_file():
+                continue
+            rel = str(path.relative_to(fdroid_dir))
+            stat = path.stat()
+            cached = cache.get(rel)
+            if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                digest = cached[2]
+            else:
+                digest = file_digest(path)
+            new_cache[rel] = [stat.st_size, stat.st_mtime_ns, digest]
+            manifest[rel] = digest
+
+    cache_file.parent.mkdir(exist_ok=True)
+    write_json(cache_file, new_cache)
+    return manifest
+
+
+def atomic_copy(src, dest):
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name("." + dest.name + ".tmp")
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+def deploy(fdroid_dir, public_dir):
+    """
+    Mirror repo/ and archive/ of the fdroid folder into the public folder,
+    transferring only the files whose hash is not the one in the manifest
+    of the last deploy. Index files are replaced last and stale files are
+    removed after that, so the public repo is consistent at every moment.
+    """
+    fdroid_dir = Path(fdroid_dir)
+    public_dir = Path(public_dir)
+    public_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = build_manifest(fdroid_dir)
+    deployed = load_json(public_dir / MANIFEST, {})
+
+    changed = [rel for rel, digest in manifest.items() if deployed.get(rel) != digest]
+    removed = [rel for rel in deployed if rel not in manifest]
+
+    print(f"[*] deploying {len(changed)} changed files, removing {len(removed)}, {len(manifest) - len(changed)} untouched")
+
+    for rel in sorted(changed, key=is_index):
+        atomic_copy(fdroid_dir / rel, public_dir / rel)
+
+    write_json(public_dir / MANIFEST, manifest)
+
+    for rel in removed:
+        if (public_dir / rel).exists():
+            (public_dir / rel).unlink()
+
+    return changed, removed
+
+
+@click.command()
+@click.argument("fdroid_dir", type=click.Path(exists=True, file_okay=False))
+@click.argument("public_dir", type=click.Path(file_okay=False))
+@click.option("--keep", default=None, type=int, help="versions of every package kept in the repo, older ones are removed before deploying")
+def run(fdroid_dir, public_dir, keep):
+    if keep is not None:
+        repo_index.prune_versions(fdroid_dir, keep)
+    deploy(fdroid_dir, public_dir)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,18 @@
+import hashlib
+from pathlib import Path
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def digest_files(paths):
+    h = hashlib.sha256()
+    for p in sorted(paths):
+        h.update(Path(p).name.encode())
+        h.update(file_digest(p).encode())
+    return h.hexdigest()
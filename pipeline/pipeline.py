@@ -0,0 +1,364 @@
+import click
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "downloader" / "python"))
+sys.path.insert(0, str(ROOT / "patcher"))
+
+import deploy
+import entrypoint
+import metrics
+import patcher
+import perf_history
+import repo_index
+import signing
+from digest import digest_files, file_digest
+from scheduler import Job, Scheduler, jvm_heap_mb
+
+STAGES = ["download", "merge", "patch", "sign", "repo"]
+# relative cost of the per package stages, a package with more work left
+# (and bigger apks) starts first so it does not end up running alone at the end
+STAGE_COST = {"download": 1, "merge": 4, "patch": 3}
+DOWNLOAD_HEAP_MB = 512
+UNKNOWN_SIZE_MB = 50
+
+
+class Workspace:
+    """
+    All the files of a package live in the same folder, every stage reads the
+    output of the previous one in place:
+
+        <root>/<package>/original/*.apk   downloaded (split) apks
+        <root>/<package>/merged.apk       single apk (not in fused mode)
+        <root>/<package>/<package>.apk    patched apk, signed in place
+        <root>/<package>/<package>.json   metadata of the patched apk (+ .png icon)
+
+    Finished stages are recorded in stages.json with the digest of their
+    inputs so a rerun can skip them.
+    """
+
+    def __init__(self, root, package):
+        self.package = package
+        self.path = Path(root) / package
+        self.original = self.path / "original"
+        self.merged = self.path / "merged.apk"
+        self.patched = self.path / f"{package}.apk"
+        self.stages_file = self.path / "stages.json"
+
+        self.original.mkdir(parents=True, exist_ok=True)
+        self.stages = self.load_stages()
+
+    def load_stages(self):
+        if not self.stages_file.exists():
+            return {}
+        with self.stages_file.open() as f:
+            return json.load(f)
+
+    def original_apks(self):
+        return sorted(self.original.glob("*.apk"))
+
+    def is_fresh(self, stage, key, output):
+        return self.stages.get(stage) == key and Path(output).exists()
+
+    def record(self, stage, key):
+        self.stages[stage] = key
+        tmp = self.stages_file.with_suffix(".tmp")
+        with tmp.open(mode="w") as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.stages_file)
+
+    def invalidate(self, stage):
+        if stage in self.stages:
+            del self.stages[stage]
+
+    def size_mb(self):
+        apks = self.original_apks()
+        if not apks:
+            return UNKNOWN_SIZE_MB
+        return sum(apk.stat().st_size for apk in apks) / (1024 * 1024)
+
+
+def size_mb(path):
+    return Path(path).stat().st_size / (1024 * 1024) if Path(path).exists() else 0
+
+
+def stage_download(ws, mail, aastoken, heap_mb=None, device_profile=None):
+    for apk in ws.original_apks():
+        apk.unlink()
+    entrypoint.run_downloader(mail, aastoken, ws.package, ws.original, heap_mb=heap_mb, device_profile=device_profile)
+
+
+def is_fused(ws, fused):
+    # a single apk is not decoded by the merge, it goes through the patch stage
+    return fused and len(ws.original_apks()) > 1
+
+
+def stage_merge(ws, force, fused, heap_mb=None, split_filter=None):
+    split_filter = split_filter or {}
+    key = digest_files(ws.original_apks())
+    # a different filter gives a different apk
+    for option, values in sorted(split_filter.items()):
+        if values:
+            key = f"{option}={','.join(sorted(values))}:" + key
+    dest = ws.merged
+    patcher_dir = None
+    if fused:
+        key = "fused:" + key
+        dest = ws.patched
+        patcher_dir = ROOT / "patcher"
+    if not force and ws.is_fresh("merge", key, dest):
+        print("[=] merge is up to date, skipping")
+        return
+    entrypoint.run_merger(
+        ws.package,
+        dest,
+        ws.original,
+        write_metadata=True,
+        patcher_dir=patcher_dir,
+        heap_mb=heap_mb,
+        **split_filter,
+    )
+    ws.record("merge", key)
+
+
+def stage_patch(ws, force, fused, heap_mb=None):
+    if fused:
+        print("[=] patched during the merge")
+        return
+    key = file_digest(ws.merged)
+    if not force and ws.is_fresh("patch", key, ws.patched):
+        print("[=] patch is up to date, skipping")
+        return
+    ws.invalidate("sign")
+    patcher.patch_apk(
+        ws.merged, ws.patched, metadata=True, deterministic=True, heap_mb=heap_mb
+    )
+    ws.record("patch", key)
+
+
+def stage_sign(workspaces, force, jobs, verify, cache_file, heap_mb=None):
+    # signing is done in place, so the key is the digest of the signed apk
+    pending = [
+        ws
+        for ws in workspaces
+        if force or not ws.is_fresh("sign", file_digest(ws.patched), ws.patched)
+    ]
+    if not pending:
+        print("[=] sign is up to date, skipping")
+        return
+    with metrics.stage("sign", apps=len(pending)):
+        signing.sign_apks(
+            [ws.patched for ws in pending],
+            jobs=jobs,
+            verify=verify,
+            cache_file=None if force else cache_file,
+            heap_mb=heap_mb,
+        )
+    for ws in pending:
+        ws.record("sign", file_digest(ws.patched))
+
+
+def link_or_copy(src, dest):
+    if dest.exists():
+        dest.unlink()
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy(src, dest)
+
+
+def stage_repo(workspaces, repo_dir, force):
+    pending = [
+        ws
+        for ws in workspaces
+        if force or not ws.is_fresh("repo", file_digest(ws.patched), ws.patched)
+    ]
+    if not pending:
+        print("[=] repo is up to date, skipping")
+        return
+    repo_dir = Path(repo_dir)
+    changed = []
+    with metrics.stage("repo", apps=len(pending)):
+        for ws in pending:
+            name = repo_index.repo_apk_name(repo_index.load_metadata(ws.patched), ws.patched.name)
+            repo_apk = repo_dir / "repo" / name
+            link_or_copy(ws.patched, repo_apk)
+            changed.append((repo_apk, ws.patched))
+
+        repo_index.update_index(repo_dir, changed)
+    for ws in pending:
+        ws.record("repo", file_digest(ws.patched))
+
+
+def package_jobs(ws, mail, aastoken, skip, force, fused, split_filter=None, device_profile=None):
+    """
+    download -> merge -> patch jobs of a package, each one waits for the
+    previous one. The heap of the merge and patch JVMs depends on the size of
+    the apks, so it is computed once the previous stage has produced them.
+    """
+    stages = [stage for stage in STAGE_COST if stage not in skip]
+
+    def priority(stage):
+        remaining = stages[stages.index(stage) :]
+        return lambda: ws.size_mb() * sum(STAGE_COST[s] for s in remaining)
+
+    def download(heap_mb):
+        print(f"[*] downloading {ws.package}")
+        stage_download(ws, mail, aastoken, heap_mb, device_profile)
+
+    def merge(heap_mb):
+        print(f"[*] merging {ws.package}")
+        stage_merge(ws, force, is_fused(ws, fused), heap_mb, split_filter)
+
+    def patch(heap_mb):
+        print(f"[*] patching {ws.package}")
+        stage_patch(ws, force, is_fused(ws, fused), heap_mb)
+
+    heaps = {
+        "download": DOWNLOAD_HEAP_MB,
+        "merge": lambda: jvm_heap_mb(ws.size_mb()),
+        "patch": lambda: None if is_fused(ws, fused) else jvm_heap_mb(size_mb(ws.merged)),
+    }
+    fns = {"download": download, "merge": merge, "patch": patch}
+
+    jobs = []
+    for stage in stages:
+        jobs.append(
+            Job(
+                f"{stage} {ws.package}",
+                fns[stage],
+                deps=jobs[-1:],
+                heap_mb=heaps[stage],
+                priority=priority(stage),
+            )
+        )
+    return jobs
+
+
+def publish(workspaces, repo_dir, force=False, keep=None, public_dir=None):
+    """Add the signed apks to the repo, prune old versions and deploy it."""
+    stage_repo(workspaces, repo_dir, force)
+    if keep is not None:
+        repo_index.prune_versions(repo_dir, keep)
+    if public_dir is not None:
+        deploy.deploy(repo_dir, public_dir)
+
+
+def setup_workspace(workspace):
+    # the history is kept with the workspace, see perf_history.py report
+    perf_history.PERF_HISTORY = os.environ.get(
+        "PERF_HISTORY", str(Path(workspace) / "perf_history.sqlite")
+    )
+    # read by aapt2_cache.py, which apktool runs as its aapt2
+    os.environ.setdefault("AAPT2_CACHE", str(Path(workspace).resolve() / "aapt2-cache"))
+    # read by the downloader (AuthSession.kt), the store login is reused by every run
+    os.environ.setdefault("AUTH_CACHE_DIR", str(Path(workspace).resolve() / "auth-cache"))
+
+
+def run_pipeline(
+    workspaces,
+    mail,
+    aastoken,
+    repo_dir,
+    skip=(),
+    force=False,
+    sign_jobs=1,
+    verify=False,
+    public_dir=None,
+    keep=None,
+    fused=True,
+    jobs=1,
+    memory_mb=None,
+    split_filter=None,
+    device_profile=None,
+):
+    scheduler = Scheduler(jobs, memory_mb)
+    chains = {}
+    for ws in workspaces:
+        for job in package_jobs(ws, mail, aastoken, skip, force, fused, split_filter, device_profile):
+            chains.setdefault(ws.package, []).append(scheduler.add(job))
+
+    failed = scheduler.run()
+    done = [
+        ws
+        for ws in workspaces
+        if all(job.state == "done" for job in chains.get(ws.package, []))
+    ]
+    # a package can get through its stages without a patched apk (e.g. --skip
+    # patch on a new workspace), it fails instead of stopping sign and repo
+    missing = [ws for ws in done if not ws.patched.exists()]
+    for ws in missing:
+        print(f"[-] {ws.package}: {ws.patched} does not exist, not signing it")
+    done = [ws for ws in done if ws.patched.exists()]
+
+    # all the apks are signed together, see signing.sign_apks
+    if "sign" not in skip and done:
+        cache_file = done[0].path.parent / "signed.json"
+        heap_mb = jvm_heap_mb(max(size_mb(ws.patched) for ws in done))
+        stage_sign(done, force, sign_jobs, verify, cache_file, heap_mb)
+
+    if "repo" not in skip and repo_dir is not None and done:
+        publish(done, repo_dir, force, keep, public_dir)
+
+    if failed or missing:
+        raise click.ClickException(
+            "failed: "
+            + ", ".join(
+                [job.name for job in failed if job.state == "failed"]
+                + [f"{ws.package} (no patched apk)" for ws in missing]
+            )
+        )
+
+
+@click.command()
+@click.argument("mail")
+@click.argument("aastoken")
+@click.argument("packagenames", nargs=-1, required=True)
+@click.option("--workspace", default="workspace", type=click.Path(file_okay=False), help="folder where every package is processed")
+@click.option("--repo", "repo_dir", default=None, type=click.Path(exists=True, file_okay=False), help="fdroid folder to update, skipped if not given")
+@click.option("--skip", multiple=True, type=click.Choice(STAGES), help="stage to skip, can be repeated")
+@click.option("--force", is_flag=True, help="run every stage even if it is up to date")
+@click.option("--sign-jobs", default=1, show_default=True, help="number of signer processes running in parallel")
+@click.option("--verify", is_flag=True, help="verify the apks after signing them")
+@click.option("--deploy", "public_dir", default=None, type=click.Path(file_okay=False), help="folder where the repo is deployed after updating it (needs --repo)")
+@click.option("--keep", default=None, type=int, help="versions of every package kept in the repo (needs --repo)")
+@click.option("--fused/--no-fused", default=True, show_default=True, help="patch split apks in the merge pass instead of decoding the merged apk again")
+@click.option("--abis", default=None, help="comma separated ABIs to merge (e.g. arm64_v8a), all of them by default")
+@click.option("--densities", default=None, help="comma separated densities to merge (e.g. xxhdpi), all of them by default")
+@click.option("--locales", default=None, help="comma separated locales to merge (e.g. en,es), all of them by default")
+@click.option("--jobs", default=1, show_default=True, help="number of download/merge/patch stages running in parallel")
+@click.option("--memory", "memory_mb", default=None, type=int, help="memory in MB the parallel stages can use, 80%% of the RAM by default")
+@click.option("--device-profile", default=None, help="bundled device profile the store sees (see downloader/python/device_profiles.py), my-device by default")
+def run(mail, aastoken, packagenames, workspace, repo_dir, skip, force, sign_jobs, verify, public_dir, keep, fused, abis, densities, locales, jobs, memory_mb, device_profile):
+    split_filter = {
+        "abis": abis.split(",") if abis else None,
+        "densities": densities.split(",") if densities else None,
+        "locales": locales.split(",") if locales else None,
+    }
+    workspaces = [Workspace(workspace, packagename) for packagename in packagenames]
+    setup_workspace(workspace)
+    run_pipeline(
+        workspaces,
+        mail,
+        aastoken,
+        repo_dir,
+        skip,
+        force,
+        sign_jobs,
+        verify,
+        public_dir,
+        keep,
+        fused,
+        jobs,
+        memory_mb,
+        split_filter,
+        device_profile,
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,185 @@
+import json
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+from digest import file_digest
+
+FDROID = os.environ.get("FDROID", "fdroid")
+
+
+def load_metadata(apk):
+    """Metadata sidecar written by merge_apk.py / patcher.py next to the apk."""
+    sidecar = Path(apk).with_suffix(".json")
+    if not sidecar.exists():
+        return None
+    with sidecar.open() as f:
+        return json.load(f)
+
+
+def signer_fingerprint(apk):
+    # fdroidserver is slow to import, only load it when an apk really changed
+    from fdroidserver import common
+
+    return common.apk_signer_fingerprint(str(apk))
+
+
+def fdroid_update(repo_dir):
+    # writes every index format (index-v1/v2, entry.json, index.xml/jar) and signs them
+    subprocess.run([FDROID, "update", "-c"], cwd=repo_dir, check=True)
+
+
+def signer_sig(apk):
+    from fdroidserver import common
+
+    return common.getsig(str(apk))
+
+
+def load_apkcache(cache_file):
+    if not cache_file.exists():
+        return None
+    with cache_file.open() as f:
+        return json.load(f)
+
+
+def write_apkcache(cache_file, cache):
+    tmp = cache_file.with_suffix(".tmp")
+    with tmp.open(mode="w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, cache_file)
+
+
+def cache_entry(apk, metadata, template):
+    """
+    Entry of fdroid's apk cache for `apk`, so `fdroid update` does not parse
+    it. The fields the sidecar does not have (features, antiFeatures...) come
+    from the cached entry of another version of the package.
+    """
+    entry = dict(template)
+    entry.pop("srcname", None)
+    entry.update(
+        {
+            "packageName": metadata["packageName"],
+            "versionCode": metadata["versionCode"],
+            "versionName": metadata["versionName"],
+            "apkName": apk.name,
+            "hash": file_digest(apk),
+            "hashType": "sha256",
+            "size": apk.stat().st_size,
+            "sig": signer_sig(apk),
+            "signer": signer_fingerprint(apk),
+            "uses-permission": [[p, None] for p in metadata["permissions"]],
+            "nativecode": metadata["nativecode"],
+            "added": time.time(),
+        }
+    )
+    if metadata.get("minSdkVersion"):
+        entry["minSdkVersion"] = int(metadata["minSdkVersion"])
+    if metadata.get("targetSdkVersion"):
+        entry["targetSdkVersion"] = int(metadata["targetSdkVersion"])
+    # icons of this version, copied to the repo by copy_icon
+    old_icon = f"{template['packageName']}.{template['versionCode']}.png"
+    new_icon = f"{metadata['packageName']}.{metadata['versionCode']}.png"
+    entry["icons"] = {
+        density: new_icon if name == old_icon else name for density, name in template.get("icons", {}).items()
+    }
+    return entry
+
+
+def copy_icon(repo_dir, apk, metadata):
+    if not metadata.get("icon"):
+        return None
+    icon = apk.parent / metadata["icon"]
+    name = f"{metadata['packageName']}.{metadata['versionCode']}.png"
+    for icons_dir in (repo_dir / "repo").glob("icons*"):
+        shutil.copy(icon, icons_dir / name)
+    return name
+
+
+def load_index(index_file):
+    with index_file.open() as f:
+        return json.load(f)
+
+
+def repo_apk_name(metadata, default):
+    """fdroid naming, one file per version so older ones can be kept"""
+    if metadata is None:
+        return default
+    return f"{metadata['packageName']}_{metadata['versionCode']}.apk"
+
+
+def prune_versions(repo_dir, keep):
+    """
+    Remove from the repo (apk and icons) every version of a package but the
+    `keep` newest ones, then let `fdroid update` drop them from every index.
+    """
+    repo_dir = Path(repo_dir)
+    index_file = repo_dir / "repo" / "index-v1.json"
+    if not index_file.exists():
+        return []
+
+    index = load_index(index_file)
+    pruned = []
+    for package, versions in index["packages"].items():
+        versions.sort(key=lambda v: v["versionCode"], reverse=True)
+        for version in versions[keep:]:
+            print(f"[-] pruning {package} {version['versionCode']}")
+            apk = repo_dir / "repo" / version["apkName"]
+            if apk.exists():
+                apk.unlink()
+            for icon in (repo_dir / "repo").glob(f"icons*/{package}.{version['versionCode']}.png"):
+                icon.unlink()
+            pruned.append(version["apkName"])
+
+    if pruned:
+        fdroid_update(repo_dir)
+    return pruned
+
+
+def update_index(repo_dir, changed):
+    """
+    Add the changed apks to the repo with `fdroid update`, which writes and
+    signs every index format. fdroid only parses the apks that are not in its
+    cache (tmp/apkcache.json), so the changed apks are added to the cache
+    first, from the metadata the pipeline already has, and fdroid no longer
+    parses them. fdroid still reads and hashes every apk of the repo on every
+    run to check its cache, so the update grows with the size of the repo, not
+    with the number of changed apks. It only avoids the parsing (aapt, the
+    signature, the icons).
+
+    `changed` is a list of (apk in the repo, apk in the workspace) tuples, the
+    metadata sidecar and icon are read next to the workspace apk.
+
+    An apk without sidecar, or of a package fdroid has not cached yet (its
+    first version), is left to fdroid to parse.
+    """
+    repo_dir = Path(repo_dir)
+    cache_file = repo_dir / "tmp" / "apkcache.json"
+    cache = load_apkcache(cache_file)
+
+    if cache is not None:
+        # newest cached version of every package, the template of its new entries
+        templates = {}
+        for entry in cache.values():
+            if isinstance(entry, dict) and "packageName" in entry:
+                current = templates.get(entry["packageName"])
+                if current is None or entry["versionCode"] > current["versionCode"]:
+                    templates[entry["packageName"]] = entry
+
+        seeded = 0
+        for repo_apk, apk in changed:
+            repo_apk, apk = Path(repo_apk), Path(apk)
+            metadata = load_metadata(apk)
+            if metadata is None or metadata["packageName"] not in templates:
+                continue
+            cache[repo_apk.name] = cache_entry(repo_apk, metadata, templates[metadata["packageName"]])
+            copy_icon(repo_dir, apk, metadata)
+            seeded += 1
+        if seeded:
+            print(f"[*] {seeded} apks added to the fdroid apk cache")
+            write_apkcache(cache_file, cache)
+
+    print("[*] updating fdroid repo")
+    fdroid_update(repo_dir)
@@ -0,0 +1,137 @@
+import os
+import threading
+import traceback
+
+# Heap given to a JVM (apktool, signer...) working on `size_mb` of apks
+JVM_MIN_HEAP_MB = 512
+JVM_HEAP_PER_APK_MB = 24
+JVM_MAX_HEAP_MB = 8192
+# Memory used by the JVM besides the heap (metaspace, code cache, threads)
+JVM_OVERHEAD = 1.25
+JVM_OVERHEAD_MB = 128
+
+
+def total_memory_mb():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 4096
+
+
+def jvm_heap_mb(size_mb):
+    return int(min(JVM_MAX_HEAP_MB, JVM_MIN_HEAP_MB + JVM_HEAP_PER_APK_MB * size_mb))
+
+
+def jvm_footprint_mb(heap_mb):
+    if heap_mb is None:
+        return JVM_OVERHEAD_MB
+    return int(heap_mb * JVM_OVERHEAD) + JVM_OVERHEAD_MB
+
+
+def evaluate(value):
+    return value() if callable(value) else value
+
+
+class Job:
+    """
+    `fn(heap_mb)` runs when all the `deps` are done. `heap_mb` (-Xmx for the
+    JVM the job starts, None if it does not start one) and `priority` can be
+    callables, they are evaluated when the job becomes ready, e.g. once the
+    apks it works on have been downloaded.
+    """
+
+    def __init__(self, name, fn, deps=(), heap_mb=None, priority=0):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self._heap_mb = heap_mb
+        self._priority = priority
+        self.heap_mb = None
+        self.priority = 0
+        self.memory_mb = 0
+        self.state = "pending"
+        self.error = None
+
+    def prepare(self):
+        self.heap_mb = evaluate(self._heap_mb)
+        self.priority = evaluate(self._priority)
+        self.memory_mb = jvm_footprint_mb(self.heap_mb)
+
+
+class Scheduler:
+    """
+    Runs jobs in threads, at most `max_jobs` at the same time and without
+    going over `memory_mb` with the memory reserved by the running jobs (a job
+    bigger than the budget runs alone). Ready jobs start by priority, the
+    highest first; smaller jobs can start before a bigger one waiting for
+    memory.
+
+    A failed job cancels every job that depends on it, the others go on.
+    """
+
+    def __init__(self, max_jobs=1, memory_mb=None):
+        self.max_jobs = max(1, max_jobs)
+        self.memory_mb = memory_mb or int(total_memory_mb() * 0.8)
+        self.jobs = []
+        self.cond = threading.Condition()
+        self.running = 0
+        self.used_mb = 0
+
+    def add(self, job):
+        self.jobs.append(job)
+        return job
+
+    def fits(self, job):
+        if self.running >= self.max_jobs:
+            return False
+        return self.running == 0 or self.used_mb + job.memory_mb <= self.memory_mb
+
+    def update_ready(self, waiting, ready):
+        for job in list(waiting):
+            if any(dep.state in ("failed", "cancelled") for dep in job.deps):
+                print(f"[-] {job.name} cancelled")
+                job.state = "cancelled"
+                waiting.remove(job)
+            elif all(dep.state == "done" for dep in job.deps):
+                job.prepare()
+                waiting.remove(job)
+                ready.append(job)
+        ready.sort(key=lambda j: j.priority, reverse=True)
+
+    def execute(self, job):
+        try:
+            job.fn(job.heap_mb)
+            state = "done"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = e
+            state = "failed"
+        with self.cond:
+            job.state = state
+            self.running -= 1
+            self.used_mb -= job.memory_mb
+            self.cond.notify_all()
+
+    def start(self, job):
+        heap = f" -Xmx{job.heap_mb}m" if job.heap_mb else ""
+        print(f"[>] {job.name}{heap}")
+        job.state = "running"
+        self.running += 1
+        self.used_mb += job.memory_mb
+        threading.Thread(target=self.execute, args=(job,), daemon=True).start()
+
+    def run(self):
+        """Run every job, returns the ones that failed or were cancelled."""
+        waiting = [job for job in self.jobs if job.state == "pending"]
+        ready = []
+        with self.cond:
+            while True:
+                self.update_ready(waiting, ready)
+                for job in list(ready):
+                    if self.fits(job):
+                        ready.remove(job)
+                        self.start(job)
+                if self.running == 0 and not ready and not waiting:
+                    break
+                self.cond.wait()
+        return [job for job in self.jobs if job.state != "done"]
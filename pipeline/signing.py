@@ -0,0 +1,109 @@
+import fcntl
+import json
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import entrypoint
+import metrics
+from digest import file_digest
+
+SIGNER_JAR = os.environ.get(
+    "SIGNER_JAR", str(Path(__file__).resolve().parent.parent / "sign" / "uber-apk-signer.jar")
+)
+
+
+class SignedCache:
+    """
+    Content hashes of every apk we have signed, stored in a json file, so an
+    apk that is already a signed artifact is not signed again.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path) if path else None
+        self.digests = self.load()
+
+    def load(self):
+        if not self.path or not self.path.exists():
+            return set()
+        with self.path.open() as f:
+            return set(json.load(f))
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+    def add(self, digest):
+        self.digests.add(digest)
+
+    def save(self):
+        if not self.path:
+            return
+        # the workers of work_queue.py (on several hosts) share the file, the
+        # digests another one saved since we loaded it are kept
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.digests |= self.load()
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix=".tmp")
+            with os.fdopen(fd, mode="w") as f:
+                json.dump(sorted(self.digests), f, indent=2)
+            os.replace(tmp, self.path)
+
+
+def run_signer(apks, only_verify=False, heap_mb=None):
+    CMD = entrypoint.java(SIGNER_JAR, heap_mb)
+    if only_verify:
+        CMD += ["--onlyVerify"]
+    else:
+        CMD += ["--allowResign", "--overwrite"]
+    CMD += ["-a"] + [str(apk) for apk in apks]
+    with metrics.jvm():
+        subprocess.run(CMD, check=True)
+
+
+def split_batches(apks, jobs):
+    jobs = max(1, min(jobs, len(apks)))
+    return [apks[i::jobs] for i in range(jobs)]
+
+
+def sign_apks(apks, jobs=1, verify=False, cache_file=None, heap_mb=None):
+    """
+    Sign (in place) all the apks with as few signer runs as possible: the apks
+    are split in `jobs` batches and every batch is signed by a single
+    uber-apk-signer process, batches run in parallel. With the default of one
+    job, a single signer signs every apk of the run. uber-apk-signer takes its
+    apks on the command line and signs them one after the other, so a signer
+    can't be kept running for apks that come later. More jobs trade one JVM
+    startup each for signing on several cores.
+
+    Returns the list of apks that were actually signed.
+    """
+    cache = SignedCache(cache_file)
+
+    to_sign = []
+    for apk in apks:
+        if file_digest(apk) in cache:
+            print(f"[=] {apk} is already signed, skipping")
+        else:
+            to_sign.append(apk)
+    metrics.cache_lookups("signed", len(apks) - len(to_sign), len(to_sign))
+
+    if not to_sign:
+        return []
+
+    print(f"[*] signing {len(to_sign)} apks in {min(jobs, len(to_sign))} signer processes")
+    batches = split_batches(to_sign, jobs)
+    with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+        list(pool.map(lambda batch: run_signer(batch, heap_mb=heap_mb), batches))
+
+    if verify:
+        print("[*] verifying signed apks")
+        with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+            list(pool.map(lambda batch: run_signer(batch, True, heap_mb), batches))
+
+    for apk in to_sign:
+        cache.add(file_digest(apk))
+    cache.save()
+
+    return to_sign
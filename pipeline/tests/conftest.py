@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# the tools of pipeline/ import each other as top level modules, pipeline.py
+# adds downloader/python and patcher itself
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
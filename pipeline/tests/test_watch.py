@@ -0,0 +1,97 @@
+import sqlite3
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+import watch
+import perf_history
+from watch import BACKOFF, CHECKS_PER_RELEASE, MAX_INTERVAL, MIN_INTERVAL, next_interval
+from work_queue import WorkQueue
+
+HOUR = 3600.0
+NOW = 1_000_000_000.0
+
+# stand-in of the store for --details-command: prints the versionCode the
+# json file gives to every package after --versions <mail> <token>
+STORE = """
+import json, sys
+versions = json.load(open(sys.argv[1]))
+packages = sys.argv[sys.argv.index("--versions") + 3:]
+for package in packages:
+    if package in versions:
+        print(f"version\\t{package}\\t{versions[package]}")
+    else:
+        print(f"missing\\t{package}\\tnot found")
+"""
+
+
+def test_new_version_checks_again_soon():
+    assert next_interval(MAX_INTERVAL, True, NOW, 48 * HOUR, NOW) == MIN_INTERVAL
+
+
+def test_unchanged_backs_off_up_to_a_day():
+    assert next_interval(HOUR, False, NOW - HOUR, None, NOW) == HOUR * BACKOFF
+    assert next_interval(MAX_INTERVAL, False, NOW - 30 * 24 * HOUR, None, NOW) == MAX_INTERVAL
+
+
+def test_release_gap_keeps_frequent_checks():
+    # released 10 hours ago, usually every 24 hours: checked 4 times per release
+    interval = next_interval(12 * HOUR, False, NOW - 10 * HOUR, 24 * HOUR, NOW)
+    assert interval == 24 * HOUR / CHECKS_PER_RELEASE
+    # never more often than MIN_INTERVAL, even for apps releasing every hour
+    assert next_interval(HOUR, False, NOW - HOUR, HOUR, NOW) == MIN_INTERVAL
+
+
+def test_release_gap_ignored_once_stale():
+    # nothing new for more than twice the usual gap, it backs off as usual
+    assert next_interval(12 * HOUR, False, NOW - 72 * HOUR, 24 * HOUR, NOW) == 12 * HOUR * BACKOFF
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # setup_workspace points these to the workspace, keep them in tmp_path
+    monkeypatch.setenv("AAPT2_CACHE", str(tmp_path / "aapt2-cache"))
+    monkeypatch.setenv("AUTH_CACHE_DIR", str(tmp_path / "auth-cache"))
+    monkeypatch.setattr(perf_history, "PERF_HISTORY", perf_history.PERF_HISTORY)
+    (tmp_path / "store.py").write_text(STORE)
+    return tmp_path
+
+
+def run_watch(tmp_path, versions, *packages):
+    (tmp_path / "versions.json").write_text(versions)
+    command = f"{sys.executable} {tmp_path / 'store.py'} {tmp_path / 'versions.json'}"
+    result = CliRunner().invoke(
+        watch.watch,
+        ["mail", "token", *packages, "--once", "--details-command", command,
+         "--db", str(tmp_path / "queue.sqlite"), "--state", str(tmp_path / "watch.sqlite"),
+         "--workspace", str(tmp_path / "workspace")],
+    )
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_watch_cycle_queues_new_versions(store):
+    output = run_watch(store, '{"com.example.a": 10, "com.example.b": 20}', "com.example.a", "com.example.b", "com.example.gone")
+
+    # seen for the first time: queued, the package the store does not have is not
+    assert "new version of com.example.a: 10" in output
+    assert "could not get the details of com.example.gone" in output
+    queue = WorkQueue(store / "queue.sqlite")
+    assert [job[0] for job in queue.jobs("queued")] == ["com.example.a", "com.example.b"]
+    rows = {row[0]: row for row in watch.Watchlist(store / "watch.sqlite").rows()}
+    assert rows["com.example.a"][1] == 10
+    assert rows["com.example.a"][4] == MIN_INTERVAL
+    assert rows["com.example.gone"][1] is None
+
+    # the workers processed them, the next check only finds a new version of a
+    queue.transaction("UPDATE jobs SET state = 'done'")
+    with sqlite3.connect(store / "watch.sqlite") as conn:
+        conn.execute("UPDATE watched SET next_check = 0")
+    output = run_watch(store, '{"com.example.a": 11, "com.example.b": 20}')
+
+    assert "new version of com.example.a: 11" in output
+    assert "com.example.b:" not in output
+    assert [job[0] for job in queue.jobs("queued")] == ["com.example.a"]
+    rows = {row[0]: row for row in watch.Watchlist(store / "watch.sqlite").rows()}
+    assert rows["com.example.b"][4] == MIN_INTERVAL * BACKOFF
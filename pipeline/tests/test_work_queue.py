@@ -0,0 +1,104 @@
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+from click.testing import CliRunner
+
+import pipeline
+import work_queue
+
+PIPELINE = Path(__file__).resolve().parent.parent
+
+# a work_queue.py worker whose process() only writes the apk of the package
+# and logs which worker got it, instead of running the stages
+WORKER = """
+import os, sys, time
+import work_queue
+from digest import file_digest
+
+db, workspace, log = sys.argv[1:4]
+worker = f"worker-{os.getpid()}"
+
+def process(ws, mail, aastoken, options):
+    ws.patched.write_bytes(ws.package.encode())
+    with open(log, "a") as f:
+        f.write(f"{ws.package} {worker}\\n")
+    time.sleep(0.05)
+    return {"apk": str(ws.patched), "digest": file_digest(ws.patched), "host": worker}
+
+work_queue.process = process
+work_queue.cli(["work", "mail", "token", "--db", db, "--workspace", workspace,
+                "--worker", worker, "--exit-when-empty", "--poll", "0.05"])
+"""
+
+PACKAGES = [f"com.example.app{i}" for i in range(12)]
+
+
+def run_workers(tmp_path, count):
+    db, workspace, log = tmp_path / "queue.sqlite", tmp_path / "workspace", tmp_path / "processed.log"
+    env = dict(os.environ, PYTHONPATH=str(PIPELINE), PERF_HISTORY=str(tmp_path / "perf.sqlite"))
+    workers = [
+        subprocess.Popen([sys.executable, "-c", WORKER, str(db), str(workspace), str(log)], env=env, cwd=tmp_path)
+        for _ in range(count)
+    ]
+    for worker in workers:
+        assert worker.wait(timeout=120) == 0
+    return [line.split() for line in log.read_text().splitlines()]
+
+
+def test_workers_share_the_queue(tmp_path):
+    queue = work_queue.WorkQueue(tmp_path / "queue.sqlite")
+    queue.enqueue(PACKAGES, max_attempts=3)
+
+    processed = run_workers(tmp_path, 4)
+
+    # every package was leased by a single worker, once
+    assert Counter(package for package, _ in processed) == Counter(PACKAGES)
+    jobs = {package: (state, attempts, worker) for package, state, attempts, _, worker, _, _ in queue.jobs()}
+    assert all(state == "done" and attempts == 1 for state, attempts, _ in jobs.values())
+    assert {package: worker for package, worker in processed} == {package: worker for package, (_, _, worker) in jobs.items()}
+    # with several workers at once
+    assert len({worker for _, worker in processed}) > 1
+
+
+def test_expired_lease_goes_to_another_worker(tmp_path):
+    queue = work_queue.WorkQueue(tmp_path / "queue.sqlite")
+    queue.enqueue(PACKAGES, max_attempts=3)
+    # a worker that died right after its claim, its lease ran out
+    dead = queue.claim("dead")
+    queue.transaction("UPDATE jobs SET lease_expires = ? WHERE package = ?", (time.time() - 1, dead))
+
+    processed = run_workers(tmp_path, 3)
+
+    assert Counter(package for package, _ in processed) == Counter(PACKAGES)
+    package, state, attempts, _, worker, result, _ = next(job for job in queue.jobs() if job[0] == dead)
+    assert (state, attempts) == ("done", 2)
+    assert worker != "dead"
+    # the dead worker coming back can neither renew nor overwrite the result
+    assert not queue.renew(dead, "dead")
+    queue.complete(dead, "dead", {"digest": "stale"})
+    assert next(job for job in queue.jobs() if job[0] == dead)[5] == result
+
+
+def test_collect_publishes_every_package_once(tmp_path, monkeypatch):
+    queue = work_queue.WorkQueue(tmp_path / "queue.sqlite")
+    queue.enqueue(PACKAGES, max_attempts=3)
+    run_workers(tmp_path, 3)
+    # changed after its worker finished, it is not the apk the queue knows
+    changed = pipeline.Workspace(tmp_path / "workspace", PACKAGES[0])
+    changed.patched.write_bytes(b"rebuilt")
+
+    published = []
+    monkeypatch.setattr(pipeline, "publish", lambda done, *args: published.extend(ws.package for ws in done))
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    result = CliRunner().invoke(
+        work_queue.cli,
+        ["collect", "--db", str(tmp_path / "queue.sqlite"), "--workspace", str(tmp_path / "workspace"), "--repo", str(repo)],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert Counter(published) == Counter(PACKAGES[1:])
@@ -0,0 +1,174 @@
+import click
+import shlex
+import sqlite3
+import subprocess
+import time
+
+# first, it puts downloader/python (entrypoint) on the path
+import pipeline
+import entrypoint
+from work_queue import WorkQueue
+
+# a package that just released is checked every MIN_INTERVAL, every check
+# without a new version waits BACKOFF times longer, up to MAX_INTERVAL
+MIN_INTERVAL = 15 * 60
+MAX_INTERVAL = 24 * 3600
+BACKOFF = 1.5
+# while a package is still within twice its usual time between releases, it is
+# checked at least 4 times per release, so fast releasing apps stay frequent
+CHECKS_PER_RELEASE = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watched (
+    package TEXT PRIMARY KEY,
+    version_code INTEGER,
+    checked REAL,
+    changed REAL,
+    release_gap REAL,
+    interval REAL NOT NULL,
+    next_check REAL NOT NULL
+);
+"""
+
+
+def lookup_versions(mail, aastoken, packages, device_profile=None, command=None):
+    """
+    package -> versionCode of the store, a single downloader run (one login) for
+    all of them. `command` replaces the downloader, e.g. a local stand-in of the
+    store printing the same lines.
+    """
+    CMD = shlex.split(command) if command else entrypoint.java(entrypoint.DOWNLOADER_JAR)
+    CMD += entrypoint.profile_args(device_profile) + ["--versions", mail, aastoken] + list(packages)
+    stdout = subprocess.run(CMD, check=True, capture_output=True, text=True).stdout
+    versions = {}
+    for line in stdout.splitlines():
+        if line.startswith("version\t"):
+            _, package, version_code = line.split("\t")
+            versions[package] = int(version_code)
+        elif line.startswith("missing\t"):
+            _, package, error = line.split("\t", 2)
+            print(f"[-] could not get the details of {package}: {error}")
+    return versions
+
+
+def next_interval(interval, is_new, changed, release_gap, now):
+    if is_new:
+        return MIN_INTERVAL
+    interval = min(MAX_INTERVAL, interval * BACKOFF)
+    if release_gap is not None and now - changed < 2 * release_gap:
+        interval = min(interval, max(MIN_INTERVAL, release_gap / CHECKS_PER_RELEASE))
+    return interval
+
+
+class Watchlist:
+    """The last versionCode of every package and when to check it again."""
+
+    def __init__(self, db):
+        self.conn = sqlite3.connect(str(db), isolation_level=None)
+        self.conn.executescript(SCHEMA)
+
+    def add(self, packages):
+        for package in packages:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO watched (package, interval, next_check) VALUES (?, ?, 0)",
+                (package, MIN_INTERVAL),
+            )
+
+    def due(self, now):
+        return [row[0] for row in self.conn.execute("SELECT package FROM watched WHERE next_check <= ? ORDER BY next_check", (now,))]
+
+    def next_check(self):
+        return self.conn.execute("SELECT MIN(next_check) FROM watched").fetchone()[0]
+
+    def update(self, package, version_code, now):
+        """Record the versionCode the store has now, True if it is a new one."""
+        old, changed, release_gap, interval = self.conn.execute(
+            "SELECT version_code, changed, release_gap, interval FROM watched WHERE package = ?", (package,)
+        ).fetchone()
+        is_new = version_code is not None and version_code != old
+        if is_new:
+            if changed is not None:
+                # moving average, a single late release does not make the package stale
+                gap = now - changed
+                release_gap = gap if release_gap is None else (release_gap + gap) / 2
+            changed = now
+        if version_code is None:
+            # lookup failed, try again later without learning anything from it
+            version_code = old
+        elif changed is None:
+            changed = now
+        interval = next_interval(interval, is_new, changed, release_gap, now)
+        self.conn.execute(
+            "UPDATE watched SET version_code = ?, checked = ?, changed = ?, release_gap = ?, interval = ?, next_check = ?"
+            " WHERE package = ?",
+            (version_code, now, changed, release_gap, interval, now + interval, package),
+        )
+        return is_new
+
+    def rows(self):
+        return self.conn.execute(
+            "SELECT package, version_code, changed, release_gap, interval, next_check FROM watched ORDER BY package"
+        ).fetchall()
+
+
+def check(watchlist, queue, mail, aastoken, packages, max_attempts, device_profile, command):
+    now = time.time()
+    try:
+        versions = lookup_versions(mail, aastoken, packages, device_profile, command)
+    except subprocess.CalledProcessError as e:
+        # the store (or the login) failed, every package is checked again later
+        print(f"[-] could not get the versions: {(e.stderr or '').strip() or e}")
+        versions = {}
+    changed = [package for package in packages if watchlist.update(package, versions.get(package), now)]
+    for package in changed:
+        print(f"[+] new version of {package}: {versions[package]}")
+    if changed:
+        queue.enqueue(changed, max_attempts)
+    return changed
+
+
+@click.command()
+@click.argument("mail")
+@click.argument("aastoken")
+@click.argument("packagenames", nargs=-1)
+@click.option("--db", default="workspace/queue.sqlite", show_default=True, type=click.Path(dir_okay=False), help="queue of work_queue.py new versions are added to")
+@click.option("--workspace", default="workspace", type=click.Path(file_okay=False), help="workspace of the workers, the login of the store is cached there")
+@click.option("--state", default="workspace/watch.sqlite", show_default=True, type=click.Path(dir_okay=False), help="versionCode and schedule of every package")
+@click.option("--max-attempts", default=3, show_default=True, help="see work_queue.py enqueue")
+@click.option("--device-profile", default=None, help="see pipeline.py")
+@click.option("--details-command", default=None, help="command run instead of the downloader to get the versions, e.g. a local stand-in of the store")
+@click.option("--once", is_flag=True, help="check the packages that are due and exit, instead of watching them")
+@click.option("--max-sleep", default=60.0, show_default=True, help="longest wait between two looks at the schedule")
+@click.option("--list", "list_only", is_flag=True, help="print the schedule of every package and exit")
+def watch(mail, aastoken, packagenames, db, workspace, state, max_attempts, device_profile, details_command, once, max_sleep, list_only):
+    """
+    Check the versionCode of the packages in the store and queue the ones that
+    have a new version for the workers of work_queue.py. A package seen for the
+    first time is queued too, packages given once stay watched.
+    """
+    pipeline.setup_workspace(workspace)
+    watchlist = Watchlist(state)
+    watchlist.add(packagenames)
+    if list_only:
+        print(f"{'package':<35}{'versionCode':>12}{'gap (h)':>9}{'every (h)':>10}  next check")
+        for package, version_code, _, release_gap, interval, next_check in watchlist.rows():
+            gap = f"{release_gap / 3600:.1f}" if release_gap else "-"
+            print(f"{package:<35}{version_code or '-':>12}{gap:>9}{interval / 3600:>10.2f}  {time.ctime(next_check)}")
+        return
+
+    queue = WorkQueue(db)
+    while True:
+        due = watchlist.due(time.time())
+        if due:
+            print(f"[*] checking {len(due)} packages")
+            check(watchlist, queue, mail, aastoken, due, max_attempts, device_profile, details_command)
+        if once:
+            break
+        next_check = watchlist.next_check()
+        if next_check is None:
+            raise click.ClickException("no package to watch")
+        time.sleep(min(max_sleep, max(1.0, next_check - time.time())))
+
+
+if __name__ == "__main__":
+    watch()
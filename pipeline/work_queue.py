@@ -0,0 +1,285 @@
+import click
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import pipeline
+from digest import file_digest
+
+# a worker renews the lease of its package every LEASE_SECONDS / 3, a package
+# whose lease expired (the worker died or lost the shared filesystem) is given
+# to another worker
+LEASE_SECONDS = 300
+RETRY_DELAY_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    package TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    updated REAL NOT NULL
+);
+"""
+
+
+class WorkQueue:
+    """
+    Packages to process, in a SQLite database every worker host can open
+    (e.g. on the shared filesystem the workspace lives on). A package is
+    queued, leased by one worker at a time, then done or failed once it
+    used all its attempts.
+    """
+
+    def __init__(self, db):
+        # no WAL, it needs shared memory that network filesystems do not have
+        self.conn = sqlite3.connect(str(db), timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def transaction(self, query, params=()):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self.conn.execute(query, params)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            return cur
+
+    def enqueue(self, packages, max_attempts):
+        for package in packages:
+            # a package queued again starts over, whatever its last state
+            self.transaction(
+                "INSERT INTO jobs (package, state, max_attempts, updated) VALUES (?, 'queued', ?, ?)"
+                " ON CONFLICT(package) DO UPDATE SET state = 'queued', attempts = 0, max_attempts = excluded.max_attempts,"
+                " not_before = 0, worker = NULL, lease_expires = NULL, result = NULL, error = NULL, updated = excluded.updated",
+                (package, max_attempts, time.time()),
+            )
+
+    def claim(self, worker):
+        """Lease the next package for `worker`, None if there is nothing to do right now."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT package FROM jobs"
+                    " WHERE (state = 'queued' AND not_before <= ?) OR (state = 'leased' AND lease_expires < ?)"
+                    " ORDER BY attempts, updated LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET state = 'leased', attempts = attempts + 1, worker = ?, lease_expires = ?, updated = ?"
+                        " WHERE package = ?",
+                        (worker, now + LEASE_SECONDS, now, row[0]),
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return row[0] if row else None
+
+    def renew(self, package, worker):
+        """Extend the lease, False if it was lost to another worker."""
+        cur = self.transaction(
+            "UPDATE jobs SET lease_expires = ? WHERE package = ? AND worker = ? AND state = 'leased'",
+            (time.time() + LEASE_SECONDS, package, worker),
+        )
+        return cur.rowcount == 1
+
+    def complete(self, package, worker, result):
+        self.transaction(
+            "UPDATE jobs SET state = 'done', result = ?, error = NULL, lease_expires = NULL, updated = ?"
+            " WHERE package = ? AND worker = ? AND state = 'leased'",
+            (json.dumps(result), time.time(), package, worker),
+        )
+
+    def fail(self, package, worker, error):
+        # queued again after a delay growing with the attempts, failed after the last one
+        now = time.time()
+        self.transaction(
+            "UPDATE jobs SET state = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,"
+            " not_before = ? + attempts * ?, error = ?, lease_expires = NULL, updated = ?"
+            " WHERE package = ? AND worker = ? AND state = 'leased'",
+            (now, RETRY_DELAY_SECONDS, error, now, package, worker),
+        )
+
+    def pending(self):
+        return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'leased')").fetchone()[0]
+
+    def jobs(self, state=None):
+        query = "SELECT package, state, attempts, max_attempts, worker, result, error FROM jobs"
+        if state:
+            return self.conn.execute(query + " WHERE state = ? ORDER BY package", (state,)).fetchall()
+        return self.conn.execute(query + " ORDER BY package").fetchall()
+
+
+class Lease:
+    """Renews the lease of a package in the background while the worker processes it."""
+
+    def __init__(self, queue, package, worker):
+        self.queue = queue
+        self.package = package
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+
+    def renew(self):
+        while not self.stopped.wait(LEASE_SECONDS / 3):
+            try:
+                if not self.queue.renew(self.package, self.worker):
+                    print(f"[-] lost the lease of {self.package}")
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                # the lease expires if this goes on, another worker takes over
+                print(f"[-] could not renew the lease of {self.package}: {e}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def process(ws, mail, aastoken, options):
+    """download -> merge -> patch -> sign of one package, in its workspace."""
+    pipeline.run_pipeline([ws], mail, aastoken, None, **options)
+    return {
+        "apk": str(ws.patched.resolve()),
+        "digest": file_digest(ws.patched),
+        "host": socket.gethostname(),
+    }
+
+
+def default_worker():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--db", default="workspace/queue.sqlite", show_default=True, type=click.Path(dir_okay=False))
+@click.option("--max-attempts", default=3, show_default=True, help="runs of a package before it is marked as failed")
+@click.argument("packagenames", nargs=-1, required=True)
+def enqueue(db, max_attempts, packagenames):
+    """Queue packages for the workers, a package already there is queued again."""
+    WorkQueue(db).enqueue(packagenames, max_attempts)
+    print(f"[+] queued {len(packagenames)} packages")
+
+
+@cli.command()
+@click.argument("mail")
+@click.argument("aastoken")
+@click.option("--db", default="workspace/queue.sqlite", show_default=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--workspace", default="workspace", type=click.Path(file_okay=False), help="folder where every package is processed, shared by the workers")
+@click.option("--worker", default=None, help="name of the worker in the queue, <host>:<pid> by default")
+@click.option("--exit-when-empty", is_flag=True, help="exit once no package is queued or leased, instead of waiting for more")
+@click.option("--poll", default=10.0, show_default=True, help="seconds between two looks at the queue when there is nothing to do")
+@click.option("--fused/--no-fused", default=True, show_default=True, help="see pipeline.py")
+@click.option("--abis", default=None, help="see pipeline.py")
+@click.option("--densities", default=None, help="see pipeline.py")
+@click.option("--locales", default=None, help="see pipeline.py")
+@click.option("--device-profile", default=None, help="see pipeline.py")
+@click.option("--verify", is_flag=True, help="verify the apks after signing them")
+@click.option("--memory", "memory_mb", default=None, type=int, help="memory in MB the stages can use, 80%% of the RAM by default")
+def work(mail, aastoken, db, workspace, worker, exit_when_empty, poll, fused, abis, densities, locales, device_profile, verify, memory_mb):
+    """Process queued packages until stopped: download, merge, patch and sign them in the workspace."""
+    queue = WorkQueue(db)
+    worker = worker or default_worker()
+    options = {
+        "verify": verify,
+        "fused": fused,
+        "memory_mb": memory_mb,
+        "device_profile": device_profile,
+        "split_filter": {
+            "abis": abis.split(",") if abis else None,
+            "densities": densities.split(",") if densities else None,
+            "locales": locales.split(",") if locales else None,
+        },
+    }
+    pipeline.setup_workspace(workspace)
+    print(f"[*] worker {worker} waiting for packages")
+    while True:
+        package = queue.claim(worker)
+        if package is None:
+            if exit_when_empty and queue.pending() == 0:
+                break
+            time.sleep(poll)
+            continue
+
+        print(f"[*] {worker} processing {package}")
+        with Lease(queue, package, worker) as lease:
+            try:
+                result = process(pipeline.Workspace(workspace, package), mail, aastoken, options)
+                error = None
+            except Exception as e:
+                error = str(e) or type(e).__name__
+        if lease.lost:
+            continue
+        if error is None:
+            queue.complete(package, worker, result)
+            print(f"[+] {package} done")
+        else:
+            queue.fail(package, worker, error)
+            print(f"[-] {package} failed: {error}")
+
+
+@cli.command()
+@click.option("--db", default="workspace/queue.sqlite", show_default=True, type=click.Path(exists=True, dir_okay=False))
+def status(db):
+    """State, attempts and worker of every package."""
+    print(f"{'package':<35}{'state':<8}{'attempts':>9}  {'worker':<25}error")
+    for package, state, attempts, max_attempts, worker, _, error in WorkQueue(db).jobs():
+        print(f"{package:<35}{state:<8}{f'{attempts}/{max_attempts}':>9}  {worker or '-':<25}{error or ''}")
+
+
+@cli.command()
+@click.option("--db", default="workspace/queue.sqlite", show_default=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--workspace", default="workspace", type=click.Path(file_okay=False), help="folder shared by the workers")
+@click.option("--repo", "repo_dir", required=True, type=click.Path(exists=True, file_okay=False), help="fdroid folder to update")
+@click.option("--wait", is_flag=True, help="wait for the queued and leased packages first")
+@click.option("--force", is_flag=True, help="add every package to the repo even if it is up to date")
+@click.option("--deploy", "public_dir", default=None, type=click.Path(file_okay=False), help="folder where the repo is deployed after updating it")
+@click.option("--keep", default=None, type=int, help="versions of every package kept in the repo")
+def collect(db, workspace, repo_dir, wait, force, public_dir, keep):
+    """Add the packages the workers finished to the repo, the index is only updated here."""
+    queue = WorkQueue(db)
+    while wait and queue.pending():
+        time.sleep(10)
+    done = []
+    for package, _, _, _, _, result, _ in queue.jobs("done"):
+        ws = pipeline.Workspace(workspace, package)
+        # the apk must still be the one the worker signed
+        if ws.patched.exists() and file_digest(ws.patched) == json.loads(result)["digest"]:
+            done.append(ws)
+        else:
+            print(f"[-] {package} changed since its worker finished, skipping it")
+    if done:
+        pipeline.publish(done, repo_dir, force, keep, public_dir)
+    failed = queue.jobs("failed")
+    for package, *_, error in failed:
+        print(f"[-] {package} failed: {error}")
+    if failed:
+        raise click.ClickException(f"{len(failed)} packages failed")
+
+
+if __name__ == "__main__":
+    cli()